@@ -0,0 +1,86 @@
+import os
+import sys
+import time
+import asyncio
+import argparse
+import logging
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from stubs import startStub, stubConfig, printLatencies
+
+# Login storm: logins per second and per-login latency, sync flask route vs the async ASGI login,
+# against a local iMIS/Moodle stub.
+#   python benchmarks/bench_login.py --logins 500 --latency 0.02 --threads 8 --inflight 100
+
+# a login counts as failed unless it ends in a redirect to moodle
+def runSync(app, logins, threads, latencies, failed):
+    def worker(tokens):
+        client = app.test_client()
+        for token in tokens:
+            start = time.perf_counter()
+            response = client.post("/login", data={"refresh_token": str(token)})
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 302: failed.append(response.status_code)
+    chunks = [range(i, logins, threads) for i in range(threads)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        list(pool.map(worker, chunks))
+    return time.perf_counter() - start
+
+async def asgiLogin(asgiapp, token):
+    body = f"refresh_token={token}".encode()
+    status = []
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+    async def send(message):
+        if message["type"] == "http.response.start": status.append(message["status"])
+    try: await asgiapp({"type": "http", "method": "POST", "path": "/login", "headers": []}, receive, send)
+    except Exception as e: return type(e).__name__ # the server would answer 500
+    return status[0]
+
+async def runAsync(asgiapp, logins, inflight, latencies, failed):
+    sem = asyncio.Semaphore(inflight)
+    async def one(token):
+        async with sem:
+            start = time.perf_counter()
+            status = await asgiLogin(asgiapp, token)
+            latencies.append(time.perf_counter() - start)
+            if status != 302: failed.append(status)
+    start = time.perf_counter()
+    await asyncio.gather(*(one(token) for token in range(logins)))
+    elapsed = time.perf_counter() - start
+    await asgiapp.client.aclose()
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--logins", type=int, default=300)
+    parser.add_argument("--latency", type=float, default=0.02, help="stub latency per call, seconds")
+    parser.add_argument("--threads", type=int, default=4, help="sync route worker threads")
+    parser.add_argument("--inflight", type=int, default=100, help="async logins in flight")
+    parser.add_argument("--errors", type=float, default=0.0, help="fraction of stub calls answered with a 503")
+    args = parser.parse_args()
+    logging.disable(logging.ERROR) # no synctask socket here
+
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+    from imismoodlebridge import create_app
+    from imismoodlebridge.asgi import create_asgi_app
+
+    server, url = startStub(args.latency, errors=args.errors)
+    config = stubConfig(url)
+    # each route gets its own instance folder, or the second would be served from the login cache the first filled
+    os.environ["WSGI_ROOT"] = tempfile.mkdtemp(prefix="bridgebench-")
+    latencies, failed = [], []
+    elapsed = runSync(create_app(config), args.logins, args.threads, latencies, failed)
+    print(f"sync  route: {args.logins} logins in {elapsed:.2f}s = {args.logins/elapsed:.1f} logins/s ({args.threads} threads), {len(failed)} failed")
+    printLatencies("  per call", {"login": latencies, **server.report()})
+    os.environ["WSGI_ROOT"] = tempfile.mkdtemp(prefix="bridgebench-")
+    latencies, failed = [], []
+    elapsed = asyncio.run(runAsync(create_asgi_app(config), args.logins, args.inflight, latencies, failed))
+    print(f"async route: {args.logins} logins in {elapsed:.2f}s = {args.logins/elapsed:.1f} logins/s ({args.inflight} in flight), {len(failed)} failed")
+    printLatencies("  per call", {"login": latencies, **server.report()})
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+from multiprocessing import Queue
+
+from stubs import startStub, stubConfig, printLatencies, Dataset
+
+# Full sync and panel refresh with the real sync task code against the local iMIS/Moodle stub.
+#   python benchmarks/bench_sync.py fullsync --members 50000 --groups 500 --latency 0.005 --workers 2
+#   python benchmarks/bench_sync.py panel --groups 2000 --touched 20 --refreshes 5
+# synctask reads config.json from the working directory, so each run gets a temporary instance folder.
+
+def makeInstance(config):
+    path = tempfile.mkdtemp(prefix="bridgebench-")
+    with open(os.path.join(path, "config.json"), "w") as f: json.dump(config, f)
+    os.chdir(path)
+    return path
+
+def printStages(snapshots):
+    from imismoodlebridge import metrics
+    merged = metrics.merge(snapshots)
+    for (name, labels), hist in sorted(merged["histograms"].items()):
+        if name != "fullsync_job_seconds": continue
+        count = sum(hist[:-1])
+        print(f"  stage {dict(labels)['stage']:8} {count:6} jobs {hist[-1]:8.2f}s worker time")
+
+def fullSync(args, server, config):
+    config.update({"WORKERS": args.workers, "SYNC_BULK_WORKERS": args.workers, "SYNC_GROUPS_PER_JOB": args.groups_per_job,
+        "SYNC_JOB_RETRY": 1})
+    makeInstance(config)
+    from imismoodlebridge import synctask
+    from imismoodlebridge.synccache import CacheDB
+    db = CacheDB(synctask.CONFIG, synctask.CACHE_DB_PATH)
+    data = server.dataset
+    print(f"{data.memberships()} memberships in {len(data.groups)} groups, {len(data.partygroups)} people, {args.workers} workers")
+    start = time.perf_counter()
+    db.getPanelSource()
+    print(f"panel source: {time.perf_counter() - start:.2f}s")
+    server.report()
+    for run in range(args.runs):
+        # the first run creates and enrols everyone, later ones should find nothing to do
+        db.queueFullSync()
+        q = Queue()
+        start = time.perf_counter()
+        processes = synctask.startWorkers(q, None)
+        while db.syncJobsPending() and any(p.is_alive() for p in processes): time.sleep(0.1)
+        elapsed = time.perf_counter() - start
+        synctask.stopProcesses(processes, q)
+        state = server.moodlestate
+        print(f"run {run+1}: {elapsed:.2f}s = {data.memberships()/elapsed:.0f} memberships/s, "
+            f"{len(state.users)} moodle users, {len(state.enrolments)} enrolments, {db.syncJobsPending()} jobs left")
+        printStages(db.loadMetrics())
+        db.db.execute("DELETE FROM metrics;")
+        db.db.commit()
+        printLatencies("  stub calls", server.report())
+
+def panelRefresh(args, server, config):
+    makeInstance(config)
+    from imismoodlebridge.synccache import CacheDB
+    db = CacheDB(config, os.path.join(os.getcwd(), "cache.sqlite"))
+    timings = {"full": [], "incremental": []}
+    for refresh in range(args.refreshes):
+        kind = "full" if refresh == 0 else "incremental"
+        if kind == "incremental": server.dataset.touch(args.touched)
+        start = time.perf_counter()
+        panel = db.acquirePanelSourceData()
+        timings[kind].append(time.perf_counter() - start)
+    print(f"{len(server.dataset.groups)} groups, {len(panel['CMap'])} mapped, {args.touched} touched per incremental refresh")
+    printLatencies("  refreshes", timings)
+    printLatencies("  stub calls", server.report())
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("scenario", choices=("fullsync", "panel"))
+    parser.add_argument("--members", type=int, default=5000, help="group memberships in iMIS")
+    parser.add_argument("--groups", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.005, help="stub latency per call, seconds")
+    parser.add_argument("--page-size", type=int, default=100, help="most items per iMIS page")
+    parser.add_argument("--errors", type=float, default=0.0, help="fraction of stub calls answered with a 503")
+    parser.add_argument("--bad", type=int, default=0, help="users moodle refuses to create")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--groups-per-job", type=int, default=10)
+    parser.add_argument("--runs", type=int, default=2, help="full syncs in a row")
+    parser.add_argument("--refreshes", type=int, default=5, help="panel refreshes, the first is a full one")
+    parser.add_argument("--touched", type=int, default=10, help="groups changed before each incremental refresh")
+    args = parser.parse_args()
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+    data = Dataset(args.members, args.groups)
+    bad = sorted(data.partygroups)[:args.bad]
+    server, url = startStub(args.latency, args.page_size, args.errors, data, bad)
+    config = stubConfig(url)
+    if args.scenario == "fullsync": fullSync(args, server, config)
+    else: panelRefresh(args, server, config)
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
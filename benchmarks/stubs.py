@@ -0,0 +1,247 @@
+import json
+import time
+import random
+import datetime
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+# Local stand-ins for iMIS and Moodle, one server for both. Enough of each API for the SSO login path,
+# the panel source refresh and the sync task: token, User/_execute, Party, Group, GroupMember,
+# GroupMemberSummary, IQA query (all paged the iMIS way) and the moodle wsfunctions we call.
+# Latency, page size and errors are set on the server, see startStub.
+
+CLIENT_ID = "bench-client"
+PANEL_IQA = "$/Bench/PanelSource"
+PRODUCT_CLASS = "E88E66B1-9516-47F9-88DC-E2EB8A3EF13E"
+
+class Dataset:
+    # Groups half event (panel code is the GroupId), half purchased product (code is the Name),
+    # each mapped to one or two courses, with memberships spread over a smaller pool of people
+    # so most users are in several groups.
+    def __init__(self, members=1000, groups=50, people=None, seed=1):
+        rng = random.Random(seed)
+        people = people or max(1, int(members*0.7))
+        old = (datetime.datetime.now() - datetime.timedelta(days=30)).strftime("%Y-%m-%dT%H:%M:%S")
+        self.groups = []
+        self.panel = []
+        for i in range(groups):
+            if i % 2:
+                group = {"GroupId": f"G{i}", "Name": f"PRODUCT{i}", "GroupClassId": PRODUCT_CLASS, "UpdatedOn": old}
+                code = group["Name"]
+            else:
+                group = {"GroupId": f"EVENT-{i}", "Name": f"Event {i}", "GroupClassId": "EVENT", "UpdatedOn": old}
+                code = group["GroupId"]
+            self.groups.append(group)
+            courses = [str(100 + i)] if i % 3 else [str(100 + i), str(100 + groups + i)]
+            self.panel.append({"IMIS_SIDE": code, "MOODLE_SIDE": ",".join(courses)})
+        self.members = {group["GroupId"]: set() for group in self.groups}
+        for n in range(members):
+            self.members[self.groups[n % groups]["GroupId"]].add(str(10000 + rng.randrange(people)))
+        self.partygroups = {}
+        for gid, ids in self.members.items():
+            for pid in ids: self.partygroups.setdefault(pid, []).append(gid)
+
+    def memberships(self):
+        return sum(len(ids) for ids in self.members.values())
+
+    def touch(self, count):
+        # mark some groups as just edited, for incremental panel refreshes
+        now = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+        for group in self.groups[:count]: group["UpdatedOn"] = now
+
+class MoodleState:
+    def __init__(self, bad=()):
+        self.lock = threading.Lock()
+        self.users = {} # username: id
+        self.enrolments = set() # (userid, courseid)
+        self.bad = set(bad) # usernames create_users rejects
+
+def email(pid):
+    return f"{pid}@example.com"
+
+def paged(items, query, pagesize):
+    offset = int(query.get("offset", 0))
+    limit = min(int(query.get("limit", pagesize)), pagesize)
+    page = items[offset:offset+limit]
+    return {"$type": "Asi.Soa.Core.DataContracts.PagedResult, Asi.Contracts",
+        "Items": {"$type": "System.Collections.Generic.List`1[[System.Object, mscorlib]], mscorlib", "$values": page},
+        "Offset": offset, "Limit": limit, "Count": len(page), "TotalCount": len(items),
+        "NextPageLink": None, "HasNext": offset + len(page) < len(items), "NextOffset": offset + len(page)}
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep-alive, same as the real servers
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, body, ctype="application/json", status=200):
+        if not isinstance(body, bytes): body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def readBody(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def handle_one_request(self):
+        # count and time every call by endpoint, see StubServer.report
+        self.endpoint = None
+        super().handle_one_request()
+        if self.endpoint is not None: self.server.record(self.endpoint, time.perf_counter() - self.start)
+
+    def parse_request(self):
+        # from the request line, not from when the idle keep-alive connection started waiting for it
+        self.start = time.perf_counter()
+        return super().parse_request()
+
+    def delay(self, endpoint):
+        # True if the call should fail
+        self.endpoint = endpoint
+        time.sleep(self.server.latency)
+        if self.server.errors and random.random() < self.server.errors:
+            self.server.record("injected 503", 0)
+            self.reply({"error": "injected"}, status=503)
+            return True
+        return False
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        path = url.path.rstrip("/")
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        data = self.server.dataset
+        pagesize = self.server.pagesize
+        if path.startswith("/api/Party/"):
+            if self.delay("iMIS Party"): return
+            pid = path.rsplit("/", 1)[1]
+            return self.reply({"Id": pid, "PersonName": {"FirstName": "Bench", "LastName": f"User{pid}"},
+                "Emails": {"$values": [{"Address": email(pid), "IsPrimary": True}]}})
+        if path == "/api/Group":
+            if self.delay("iMIS Group"): return
+            groups = [g for g in data.groups if g["GroupClassId"] == query.get("GroupClassId", g["GroupClassId"])]
+            since = query.get("UpdatedOn", "")
+            if since.startswith("gt:"): groups = [g for g in groups if g["UpdatedOn"] > since[3:]]
+            return self.reply(paged(groups, query, pagesize))
+        if path == "/api/GroupMemberSummary":
+            if self.delay("iMIS GroupMemberSummary"): return
+            items = [{"Party": {"Id": pid, "Email": email(pid)}} for pid in sorted(data.members.get(query.get("GroupID"), ()))]
+            return self.reply(paged(items, query, pagesize))
+        if path == "/api/GroupMember":
+            if self.delay("iMIS GroupMember"): return
+            pid = query.get("PartyID")
+            items = [{"Group": {"GroupId": gid}, "Party": {"Id": pid, "Email": email(pid)}} for gid in data.partygroups.get(pid, ())]
+            return self.reply(paged(items, query, pagesize))
+        if path == "/api/query":
+            if self.delay("iMIS query"): return
+            rows = data.panel if query.get("QueryName") == PANEL_IQA else []
+            return self.reply(paged(rows, query, pagesize))
+        self.send_error(404)
+
+    def do_POST(self):
+        path = urlparse(self.path).path.rstrip("/")
+        body = self.readBody()
+        if path in ("/token", "/api/token"):
+            if self.delay("iMIS token"): return
+            form = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+            if form.get("grant_type") == "password":
+                return self.reply({"access_token": "bench", "token_type": "bearer", "expires_in": 3600, "userName": form.get("username")})
+            token = form["refresh_token"]
+            return self.reply({"userName": f"user{token}", "as:client_id": CLIENT_ID, "access_token": token})
+        if path == "/api/User/_execute":
+            if self.delay("iMIS User/_execute"): return
+            username = json.loads(body)["Parameters"]["$values"][0]["$value"]
+            return self.reply({"Result": {"IsAnonymous": False, "UserId": username[4:]}})
+        if path == "/webservice/rest/server.php":
+            form = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+            if self.delay(f"moodle {form.get('wsfunction')}"): return
+            return self.reply(self.moodle(form["wsfunction"], form))
+        self.send_error(404)
+
+    def moodle(self, wsfunction, form):
+        state = self.server.moodlestate
+        def items(prefix, field):
+            i = 0
+            while f"{prefix}[{i}][{field}]" in form:
+                yield i
+                i += 1
+        def error(code, message):
+            return {"exception": "moodle_exception", "errorcode": code, "message": message}
+        with state.lock:
+            if wsfunction == "auth_userkey_request_login_url":
+                return {"loginurl": f"http://moodle.invalid/login?user={form['user[username]']}"}
+            if wsfunction == "core_user_get_users_by_field":
+                values = [v for k, v in form.items() if k.startswith("values[")]
+                return [{"id": state.users[v], "username": v, "email": email(v)} for v in values if v in state.users]
+            if wsfunction == "core_user_create_users":
+                names = [form[f"users[{i}][username]"] for i in items("users", "username")]
+                for name in names:
+                    if name in state.bad: return error("invalidparameter", f"Invalid user {name}")
+                    if name in state.users: return error("invalidparameter", f"Username already exists: {name}")
+                for name in names: state.users[name] = len(state.users) + 2
+                return [{"id": state.users[name], "username": name} for name in names]
+            if wsfunction in ("enrol_manual_enrol_users", "enrol_manual_unenrol_users"):
+                pairs = [(form[f"enrolments[{i}][userid]"], form[f"enrolments[{i}][courseid]"]) for i in items("enrolments", "userid")]
+                if wsfunction == "enrol_manual_enrol_users": state.enrolments.update(pairs)
+                else: state.enrolments.difference_update(pairs)
+                return None
+        return error("invalidrecord", f"Can't find data record in database table external_functions. {wsfunction}")
+
+class StubServer(ThreadingHTTPServer):
+    request_queue_size = 256
+    daemon_threads = True
+
+    def record(self, endpoint, seconds):
+        with self.statslock: self.stats.setdefault(endpoint, []).append(seconds)
+
+    def report(self):
+        # {endpoint: [durations]}, and start counting again
+        with self.statslock:
+            stats, self.stats = self.stats, {}
+        return stats
+
+def startStub(latency=0.02, pagesize=100, errors=0.0, dataset=None, bad=()):
+    # errors: fraction of calls that get a 503
+    server = StubServer(("127.0.0.1", 0), StubHandler)
+    server.latency = latency
+    server.pagesize = pagesize
+    server.errors = errors
+    server.dataset = dataset or Dataset()
+    server.moodlestate = MoodleState(bad)
+    server.stats = {}
+    server.statslock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+def stubConfig(url):
+    return {
+        "HOMEPAGE": url,
+        "IMIS_MOODLE_LOGIN_PAGE": f"{url}/login-page",
+        "IMIS_CLIENT_ID": CLIENT_ID,
+        "IMIS_CLIENT_SECRET": "secret",
+        "MOODLE_URL": url,
+        "MOODLE_AUTH_TOKEN": "token",
+        "MOODLE_FUNCTION": "auth_userkey_request_login_url",
+        "MOODLE_SYNC_TOKEN": "token",
+        "API_URL": f"{url}/api/",
+        "iMIS_User": "bench",
+        "iMIS_Password": "bench",
+        "iMIS_PANELSOURCE_IQA": PANEL_IQA,
+        "iMIS_PURCHASED_PRODUCTS_CLASS_ID": PRODUCT_CLASS,
+        "HTTP_POOL_SIZE": 50,
+        "LOG_LEVEL": "ERROR",
+    }
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values: return 0
+    return values[min(len(values)-1, int(round(p/100*(len(values)-1))))]
+
+def printLatencies(title, stats):
+    # stats: {name: [seconds]}
+    print(title)
+    print(f"  {'':40} {'calls':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for name, values in sorted(stats.items()):
+        print(f"  {name:40} {len(values):7} " + " ".join(f"{percentile(values, p)*1000:8.1f}" for p in (50, 95, 99, 100)))
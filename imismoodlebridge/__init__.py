@@ -1,8 +1,11 @@
 import os
 import json
-from flask import Flask
+import click
+from flask import Flask, current_app
 
 from .routes import bp
+from . import httpclient
+from .synccache import CacheDB
 
 
 def create_app(test_config=None):
@@ -19,6 +22,7 @@ def create_app(test_config=None):
     # ensure the instance folder exists
     try: os.makedirs(app.instance_path)
     except OSError: pass
+    httpclient.configure(app.config)
     setup_app(app)
     return app
 
@@ -26,6 +30,23 @@ def setup_app(app):
     # Create tables if they do not exist already
     app.register_blueprint(bp, url_prefix='')
 
+def cacheDB():
+    return CacheDB(current_app.config, os.path.join(current_app.instance_path, "cache.sqlite"))
+
 @bp.cli.command("initdb")
 def initdb():
-    pass
\ No newline at end of file
+    """Create the cache.sqlite tables."""
+    # tables are created on connect
+    cacheDB()
+    click.echo("cache.sqlite ready.")
+
+@bp.cli.command("fullsync")
+@click.option("--restart", is_flag=True, help="Throw away an unfinished full sync and start again.")
+def fullsync(restart):
+    """Queue a full sync now, or resume an unfinished one. Synctask workers pick it up."""
+    db = cacheDB()
+    pending = db.syncJobsPending()
+    if pending and not restart:
+        click.echo(f"Resuming full sync, {pending} jobs left.")
+        return
+    click.echo(f"Queued full sync, {db.queueFullSync()} jobs.")
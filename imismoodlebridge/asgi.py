@@ -0,0 +1,151 @@
+import os
+import json
+import asyncio
+import logging
+from urllib.parse import parse_qs
+import httpx
+from asgiref.wsgi import WsgiToAsgi
+
+from . import create_app
+from .imisUtil import FIND_BY_USERNAME, findEmail
+from .moodle import flattenParams, decodeResponse
+from .httpclient import DEFAULTS
+from .logincache import getLoginCache, userKey, partyKey
+from .notifier import getNotifier
+from . import metrics
+
+log = logging.getLogger()
+
+# Async variant of routes.login. Run with an ASGI server, e.g.
+#   uvicorn --factory imismoodlebridge.asgi:create_asgi_app
+# POST /login is served here with a shared async HTTP client so a single worker can have many
+# logins in flight. Everything else is handed to the normal flask app.
+# The login cache is sqlite backed (blocking, with a busy timeout), so it's used from a thread.
+
+class LoginError(Exception):
+    pass
+
+def newClient(config):
+    timeout = config.get("HTTP_TIMEOUT", DEFAULTS["HTTP_TIMEOUT"])
+    if isinstance(timeout, list): timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+    poolsize = config.get("HTTP_POOL_SIZE", DEFAULTS["HTTP_POOL_SIZE"])
+    transport = httpx.AsyncHTTPTransport(retries=config.get("HTTP_RETRIES", DEFAULTS["HTTP_RETRIES"]),
+        limits=httpx.Limits(max_connections=poolsize*4, max_keepalive_connections=poolsize))
+    return httpx.AsyncClient(transport=transport, timeout=timeout)
+
+async def getiMISTokenData(client, url, clientid, clientsecret, refreshtoken):
+    with metrics.timer("imis_request_seconds", endpoint="token"):
+        response = await client.post(f"{url}/token", data={
+            "grant_type": "refresh_token", "client_id": clientid,
+            "client_secret": clientsecret, "refresh_token": refreshtoken})
+    return response.json()
+
+async def getiMISUserData(client, url, username, access_token):
+    headers = { "Authorization": f"Bearer {access_token}", "Content-Type": "application/json" }
+    body = json.loads(json.dumps(FIND_BY_USERNAME))
+    body["Parameters"]["$values"][0]["$value"] = username
+    with metrics.timer("imis_request_seconds", endpoint="FindByUserName"):
+        response = await client.post(f"{url}/api/User/_execute", json=body, headers=headers)
+    return response.json()["Result"]
+
+async def getiMISProfileData(client, url, userid, access_token):
+    headers = { "Authorization": f"Bearer {access_token}", "Content-Type": "application/json" }
+    with metrics.timer("imis_request_seconds", endpoint="Party"):
+        response = await client.get(f"{url}/api/Party/{userid}", headers=headers)
+    return response.json()
+
+async def moodleLoginURL(client, config, cache, imisid, socketpath, access_token):
+    profiledata = await asyncio.to_thread(cache.get, partyKey(imisid))
+    if profiledata is None:
+        profiledata = await getiMISProfileData(client, config['HOMEPAGE'], imisid, access_token)
+        await asyncio.to_thread(cache.put, partyKey(imisid), imisid, profiledata)
+    postdata = [("wstoken", config["MOODLE_AUTH_TOKEN"]), ("wsfunction", config["MOODLE_FUNCTION"]),
+        ("moodlewsrestformat", "json")]
+    postdata.extend(flattenParams({"user": {
+        "username": imisid,
+        "firstname": profiledata["PersonName"]["FirstName"],
+        "lastname": profiledata["PersonName"]["LastName"],
+        "email": findEmail(profiledata),
+    }}))
+    with metrics.timer("moodle_request_seconds", wsfunction=config["MOODLE_FUNCTION"]):
+        response = await client.post(f"{config['MOODLE_URL']}/webservice/rest/server.php", data=dict(postdata))
+    loginurl = decodeResponse(config["MOODLE_FUNCTION"], response.text)["loginurl"]
+    # only now, so auth_userkey has created a first time user before synctask goes looking for them
+    getNotifier(socketpath).notify(imisid)
+    return loginurl
+
+# returns url to redirect to, raises LoginError for a 500.
+async def loginPipeline(client, config, cache, socketpath, refresh_token):
+    config_clientid = config["IMIS_CLIENT_ID"]
+    tokendata = await getiMISTokenData(client, config['HOMEPAGE'], config_clientid,
+        config["IMIS_CLIENT_SECRET"], refresh_token)
+    if "userName" not in tokendata:
+        log.error(f"Missing Username. TokenData: {tokendata}")
+        return config['HOMEPAGE']
+    if tokendata["userName"] == "GUEST":
+        log.error("Attempting to login with GUEST access. You should gatekeep your SSO iPart page with authenticated users only.")
+        return config['HOMEPAGE']
+    try:
+        clientid = tokendata["as:client_id"]
+        if clientid != config_clientid:
+            log.error(f"ClientID mismatch. Detected clientid: {clientid}, Config clientid: {config_clientid}")
+            raise LoginError()
+    except KeyError:
+        log.error(f"Invalid setup - Check clientid and secret. Config ClientID: {config_clientid}, Error: {tokendata}.")
+        raise LoginError()
+    imisUserData = await asyncio.to_thread(cache.get, userKey(tokendata["userName"]))
+    if imisUserData is None:
+        imisUserData = await getiMISUserData(client, config['HOMEPAGE'], tokendata["userName"], tokendata["access_token"])
+        if (imisUserData["IsAnonymous"]): return config["IMIS_MOODLE_LOGIN_PAGE"]
+        await asyncio.to_thread(cache.put, userKey(tokendata["userName"]), imisUserData["UserId"], imisUserData)
+    return await moodleLoginURL(client, config, cache, imisUserData["UserId"], socketpath, tokendata["access_token"])
+
+class LoginApp:
+    def __init__(self, app):
+        self.app = app
+        self.config = app.config
+        self.socketpath = os.path.join(app.instance_path, "socket")
+        self.cachepath = os.path.join(app.instance_path, "cache.sqlite")
+        self.wsgi = WsgiToAsgi(app)
+        self.client = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+        if scope["type"] == "http" and scope["method"] == "POST" and scope["path"] == "/login":
+            return await self.login(receive, send)
+        return await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self.client = newClient(self.config)
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self.client is not None: await self.client.aclose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def login(self, receive, send):
+        # servers without lifespan support
+        if self.client is None: self.client = newClient(self.config)
+        body = b""
+        more = True
+        while more:
+            message = await receive()
+            body += message.get("body", b"")
+            more = message.get("more_body", False)
+        refresh_token = parse_qs(body.decode()).get("refresh_token", [None])[0]
+        try:
+            cache = await asyncio.to_thread(getLoginCache, self.config, self.cachepath)
+            url = await loginPipeline(self.client, self.config, cache, self.socketpath, refresh_token)
+            await send({"type": "http.response.start", "status": 302,
+                "headers": [(b"location", url.encode()), (b"content-length", b"0")]})
+        except LoginError:
+            await send({"type": "http.response.start", "status": 500,
+                "headers": [(b"content-length", b"0")]})
+        await send({"type": "http.response.body", "body": b""})
+
+def create_asgi_app(test_config=None):
+    return LoginApp(create_app(test_config))
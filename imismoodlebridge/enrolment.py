@@ -0,0 +1,166 @@
+import time
+import queue
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from .moodle import MoodleError, bisectBatches
+from .ratelimit import BackendUnavailable
+from . import metrics
+logger = logging.getLogger(__name__)
+
+# Collects enrolments from many tasks into enrol_manual_enrol_users batches.
+# A batch goes out when it is full (count or bytes) or ENROL_FLUSH_WINDOW seconds after its first item.
+# At most ENROL_CONCURRENCY batches are in flight, submit() blocks the flusher (not the caller) beyond that.
+# Results come back through results() as (key, userid, courseid, result) so the caller can record them
+# on its own thread/sqlite connection.
+
+ENROLLED = "ok"
+REJECTED = "rejected" # moodle refused the item, but not because of the user (course gone, manual enrolment off...)
+BAD_USER = "baduser" # moodle has no such user (any more)
+TRANSIENT = "transient" # never got an answer from moodle (connection error, circuit open), try again later
+USER_ERRORS = ("invaliduser", "invaliduserid", "usernotexist", "userdeleted")
+
+def isUserError(error):
+    # enrol_manual_enrol_users has no errorcode of its own for a missing or deleted user,
+    # role_assign throws a coding_exception saying "User ID does not exist or is deleted!".
+    if error is None: return False
+    return error.errorcode in USER_ERRORS or (error.errorcode == "codingerror" and "user id" in str(error.message).lower())
+
+class EnrolmentScheduler:
+    def __init__(self, client, config):
+        self.client = client
+        self.roleid = config.get("STUDENT_ROLE_ID", 5)
+        self.maxcount = config.get("ENROL_BATCH_SIZE", 100)
+        self.maxbytes = config.get("ENROL_BATCH_BYTES", 60000)
+        self.window = config.get("ENROL_FLUSH_WINDOW", 0.2)
+        self.retries = config.get("ENROL_RETRIES", 3)
+        concurrency = config.get("ENROL_CONCURRENCY", 2)
+        self.stats = {"calls": 0, "isolated": 0, "batches": 0, "enrolled": 0, "failed": 0}
+        self.pending = []
+        self.pendingbytes = 0
+        self.first = None
+        self.sending = 0
+        self.flushing = False
+        self.closed = False
+        self.cond = threading.Condition()
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.pool = ThreadPoolExecutor(concurrency)
+        self.done = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, userid, courseid, key=None):
+        item = {"roleid": self.roleid, "userid": userid, "courseid": courseid}
+        # roughly what it adds to the POST body: enrolments[n][roleid]=5&enrolments[n][userid]=...
+        size = 3*len("&enrolments[000][courseid]=") + len(str(self.roleid)) + len(str(userid)) + len(str(courseid))
+        with self.cond:
+            self.pending.append((item, key, size))
+            self.pendingbytes += size
+            if self.first is None: self.first = time.monotonic()
+            if self.full(): self.cond.notify_all()
+
+    def full(self):
+        return len(self.pending) >= self.maxcount or self.pendingbytes >= self.maxbytes
+
+    def take(self):
+        batch = []
+        size = 0
+        while self.pending and len(batch) < self.maxcount and (not batch or size + self.pending[0][2] <= self.maxbytes):
+            entry = self.pending.pop(0)
+            batch.append(entry)
+            size += entry[2]
+        self.pendingbytes -= size
+        self.first = time.monotonic() if self.pending else None
+        return batch
+
+    def run(self):
+        with self.cond:
+            while True:
+                if not self.pending:
+                    if self.closed: return
+                    self.cond.wait()
+                    continue
+                wait = self.first + self.window - time.monotonic()
+                if wait > 0 and not (self.full() or self.flushing or self.closed):
+                    self.cond.wait(wait)
+                    continue
+                batch = self.take()
+                self.sending += 1
+                self.cond.release()
+                try:
+                    self.slots.acquire()
+                    self.pool.submit(self.send, batch)
+                finally:
+                    self.cond.acquire()
+
+    def send(self, batch):
+        stats = {"calls": 0, "isolated": 0}
+        sent = set() # id(entry) moodle accepted
+        errors = {} # id(entry): MoodleError, for items moodle rejected on their own
+        def post(entries):
+            try:
+                self.client.enrolUsers(entry[0] for entry in entries)
+                sent.update(id(entry) for entry in entries)
+                return True
+            except MoodleError as e:
+                logger.debug("Enrolment batch of %s failed: %s", len(entries), e)
+                if len(entries) == 1: errors[id(entries[0])] = e
+                return False
+        remaining = batch
+        for attempt in range(self.retries + 1):
+            try:
+                # moodle rejects the whole batch on one bad item, retry the rest in halves
+                bisectBatches(remaining, len(remaining), post, stats)
+            except BackendUnavailable as e:
+                # moodle is down for now, wait for the circuit to close rather than failing everyone
+                remaining = [entry for entry in batch if id(entry) not in sent and id(entry) not in errors]
+                if attempt < self.retries:
+                    logger.warning("%s, holding an enrolment batch of %s.", e, len(remaining))
+                    time.sleep(max(0, e.until - time.time()))
+                    continue
+                logger.error("Enrolment batch failed: %s", e)
+            except Exception as e:
+                # connection reset, timeout... says nothing about the items, whatever wasn't sent is TRANSIENT
+                logger.error("Enrolment batch failed: %s", e)
+            break
+        counts = {}
+        for entry in batch:
+            if id(entry) in sent: result = ENROLLED
+            elif id(entry) not in errors: result = TRANSIENT
+            elif isUserError(errors[id(entry)]): result = BAD_USER
+            else: result = REJECTED
+            counts[result] = counts.get(result, 0) + 1
+            self.done.put((entry[1], entry[0]["userid"], entry[0]["courseid"], result))
+        for result, count in counts.items(): metrics.inc("enrolments_total", count, result=result)
+        with self.cond:
+            self.stats["batches"] += 1
+            self.stats["calls"] += stats["calls"]
+            self.stats["isolated"] += stats["isolated"]
+            self.stats["enrolled"] += counts.get(ENROLLED, 0)
+            self.stats["failed"] += len(batch) - counts.get(ENROLLED, 0)
+            self.sending -= 1
+            self.cond.notify_all()
+        self.slots.release()
+
+    def results(self):
+        items = []
+        while True:
+            try: items.append(self.done.get_nowait())
+            except queue.Empty: return items
+
+    def wait(self):
+        # send everything pending now and wait for all batches to finish
+        with self.cond:
+            self.flushing = True
+            self.cond.notify_all()
+            while self.pending or self.sending:
+                self.cond.wait()
+            self.flushing = False
+
+    def close(self):
+        self.wait()
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+        self.pool.shutdown()
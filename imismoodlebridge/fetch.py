@@ -0,0 +1,93 @@
+import queue
+import threading
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from .httpclient import backendLimit, acquire, record
+from .ratelimit import BackendUnavailable
+from . import metrics
+logger = logging.getLogger(__name__)
+
+# Runs several iMIS apiIterator scans at once on one openAPI instance (one token/session per worker).
+# Each scan pages on its own thread into a bounded queue, so the next pages are already being fetched
+# while the caller works through the current ones.
+
+_DONE = object()
+
+def throttled(iterator, backend, endpoint="unknown"):
+    # iMISpy does its own paging, so hold the backend limit while it fetches the next item/page.
+    # Its requests aren't visible from here, so the rate limit is spent once per scan and the slowest
+    # page (or the scan failing) is what feeds back into it, see httpclient.backendCall.
+    # The time spent waiting on the whole scan goes to the metrics.
+    acquire(backend)
+    iterator = iter(iterator)
+    limit = backendLimit(backend)
+    waited = 0
+    slowest = 0
+    items = 0
+    try:
+        while True:
+            with limit:
+                start = time.monotonic()
+                try: item = next(iterator)
+                except StopIteration: break
+                except Exception as e:
+                    until = record(backend, False, time.monotonic() - start)
+                    if until: raise BackendUnavailable(backend, until) from e
+                    raise
+                finally:
+                    elapsed = time.monotonic() - start
+                    waited += elapsed
+                    slowest = max(slowest, elapsed)
+            items += 1
+            yield item
+        record(backend, True, slowest)
+    finally:
+        metrics.observe("imis_scan_seconds", waited, endpoint=endpoint)
+        metrics.inc("imis_items_total", items, endpoint=endpoint)
+
+class _Failed:
+    def __init__(self, error):
+        self.error = error
+
+# jobs is [(key, params)], yields (key, item) so the caller knows which scan an item came from.
+def iterParallel(api, endpoint, jobs, workers=4, prefetch=1000):
+    jobs = list(jobs)
+    if not jobs: return
+    items = queue.Queue(prefetch)
+    stop = threading.Event()
+    def put(item):
+        # give up if the consumer went away
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.5)
+                return True
+            except queue.Full: pass
+        return False
+    def scan(key, params):
+        try:
+            for item in throttled(api.apiIterator(endpoint, params), "imis", endpoint):
+                if not put((key, item)): return
+        except Exception as e:
+            put(_Failed(e))
+        finally:
+            put(_DONE)
+    pool = ThreadPoolExecutor(min(workers, len(jobs)))
+    try:
+        for key, params in jobs: pool.submit(scan, key, params)
+        remaining = len(jobs)
+        while remaining:
+            item = items.get()
+            if item is _DONE: remaining -= 1
+            elif isinstance(item, _Failed): raise item.error
+            else: yield item
+    finally:
+        stop.set()
+        pool.shutdown(wait=True)
+
+def iterGroupMembers(api, groupids, config):
+    # (groupid, {"username", "email"}) for every membership of the groups, streamed as they arrive
+    jobs = ((gid, [["GroupID", gid]]) for gid in groupids)
+    for gid, imisdata in iterParallel(api, "GroupMemberSummary", jobs,
+            config.get("IMIS_FETCH_WORKERS", 4), config.get("IMIS_PREFETCH", 1000)):
+        yield gid, {"username": imisdata["Party"]["Id"], "email": imisdata["Party"]["Email"]}
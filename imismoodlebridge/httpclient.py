@@ -0,0 +1,127 @@
+import os
+import time
+import logging
+import contextlib
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from .ratelimit import BackendUnavailable
+logger = logging.getLogger(__name__)
+
+# defaults, override in config.json
+DEFAULTS = {
+    "HTTP_POOL_CONNECTIONS": 4, # number of hosts to keep pools for (iMIS, Moodle, ...)
+    "HTTP_POOL_SIZE": 10, # keep-alive connections per host
+    "HTTP_TIMEOUT": [5, 30], # connect, read seconds
+    "HTTP_RETRIES": 3,
+    "HTTP_BACKOFF": 0.5,
+}
+RETRY_STATUS = (429, 502, 503, 504)
+# the server turned the request away before doing anything with it
+REFUSED_STATUS = (429, 503)
+
+_settings = dict(DEFAULTS)
+_session = None
+_pid = None
+_limits = {} # backend name: (host, semaphore shared between processes)
+_limiter = None # ratelimit.RateLimiter, synctask workers only
+
+class SafeRetry(Retry):
+    # A 502/504 can come from a proxy after moodle already ran the call, so those are only repeated for
+    # idempotent methods. POSTs (user creation, enrolment, token refresh) are only repeated on REFUSED_STATUS.
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if status_code not in REFUSED_STATUS and method.upper() not in Retry.DEFAULT_ALLOWED_METHODS: return False
+        return super().is_retry(method, status_code, has_retry_after)
+
+class PooledSession(requests.Session):
+    # requests has no session wide timeout, so apply one unless the caller gave their own.
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        with backendCall(hostBackend(urlparse(url).hostname)) as call:
+            response = call["response"] = super().request(method, url, **kwargs)
+            call["ok"] = response.status_code not in RETRY_STATUS and response.status_code < 500
+            return response
+
+def configure(config):
+    # pick up HTTP_* settings from the app/synctask config. Next getSession() builds a new pool.
+    global _session
+    for key in DEFAULTS:
+        _settings[key] = config.get(key, DEFAULTS[key])
+    if _session is not None: _session.close()
+    _session = None
+
+def newSession(settings=None):
+    settings = settings or _settings
+    timeout = settings["HTTP_TIMEOUT"]
+    if isinstance(timeout, list): timeout = tuple(timeout)
+    session = PooledSession(timeout)
+    # moodle web service calls are POSTs, retry those too. Retry-After is honoured on 429/503.
+    # Never after a read error though, the server may have acted on it (a user created, a token
+    # refreshed) and sending it again makes it fail. Connect errors are safe, statuses see SafeRetry.
+    retry = SafeRetry(total=settings["HTTP_RETRIES"], read=0, backoff_factor=settings["HTTP_BACKOFF"],
+        status_forcelist=RETRY_STATUS, allowed_methods=None, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=settings["HTTP_POOL_CONNECTIONS"],
+        pool_maxsize=settings["HTTP_POOL_SIZE"], max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def getSession():
+    # one session per process. Sockets must not be shared over fork, so rebuild in child processes.
+    global _session, _pid
+    if _session is None or _pid != os.getpid():
+        logger.debug("Creating pooled HTTP session for pid %s", os.getpid())
+        _session = newSession()
+        _pid = os.getpid()
+    return _session
+
+def setLimits(limits):
+    # {"moodle": (host, semaphore)}, caps concurrent requests per backend across all processes given the semaphores.
+    _limits.clear()
+    _limits.update(limits)
+
+def setLimiter(limiter):
+    global _limiter
+    _limiter = limiter
+
+def backendLimit(name):
+    if name in _limits: return _limits[name][1]
+    return contextlib.nullcontext()
+
+def hostBackend(host):
+    for name, (limithost, sem) in _limits.items():
+        if limithost == host: return name
+    return None
+
+def acquire(name):
+    # waits for the backend's rate limit, raises ratelimit.BackendUnavailable while its circuit is open
+    if _limiter is not None and name is not None: _limiter.acquire(name)
+
+def record(name, ok, latency):
+    # returns when the backend's circuit closes if this failure left it open, else 0
+    if _limiter is not None and name is not None: return _limiter.record(name, ok, latency)
+    return 0
+
+@contextlib.contextmanager
+def backendCall(name):
+    # one request: rate limit, concurrency limit, then the outcome feeds back into the rate.
+    # The caller sets call["ok"] = False for error responses, exceptions count as failures.
+    # A failure that leaves the circuit open raises BackendUnavailable, so its task is parked like the ones after it.
+    acquire(name)
+    call = {"ok": True, "response": None}
+    start = time.monotonic()
+    try:
+        with backendLimit(name): yield call
+    except Exception as e:
+        until = record(name, False, time.monotonic() - start)
+        if until: raise BackendUnavailable(name, until) from e
+        raise
+    until = record(name, call["ok"], time.monotonic() - start)
+    if until:
+        if call["response"] is not None: call["response"].close()
+        raise BackendUnavailable(name, until)
@@ -1,6 +1,7 @@
 import json
-import requests
 import logging
+from .httpclient import getSession
+from . import metrics
 log = logging.getLogger()
 
 FIND_BY_USERNAME = {
@@ -26,20 +27,23 @@ FIND_BY_USERNAME = {
 }
 
 def getiMISTokenData(url, clientid, clientsecret, refreshtoken):
-    return requests.post(f"{url}/token", data={
-        "grant_type": "refresh_token", "client_id": clientid,
-        "client_secret": clientsecret, "refresh_token": refreshtoken}).json()
+    with metrics.timer("imis_request_seconds", endpoint="token"):
+        return getSession().post(f"{url}/token", data={
+            "grant_type": "refresh_token", "client_id": clientid,
+            "client_secret": clientsecret, "refresh_token": refreshtoken}).json()
 
 def getiMISUserData(url, username, clientid, access_token):
     headers = { "Authorization": f"Bearer {access_token}", "Content-Type": "application/json" }
     body = json.loads(json.dumps(FIND_BY_USERNAME))
     body["Parameters"]["$values"][0]["$value"] = username
-    result = requests.post(f"{url}/api/User/_execute", json=body, headers=headers).json()
+    with metrics.timer("imis_request_seconds", endpoint="FindByUserName"):
+        result = getSession().post(f"{url}/api/User/_execute", json=body, headers=headers).json()
     return result["Result"]
 
 def getiMISProfileData(url, userid, access_token):
     headers = { "Authorization": f"Bearer {access_token}", "Content-Type": "application/json" }
-    return requests.get(f"{url}/api/Party/{userid}", headers=headers).json()
+    with metrics.timer("imis_request_seconds", endpoint="Party"):
+        return getSession().get(f"{url}/api/Party/{userid}", headers=headers).json()
 
 def findEmail(partyData):
     email = None
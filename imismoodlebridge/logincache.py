@@ -0,0 +1,125 @@
+import os
+import sqlite3
+import json
+import time
+import threading
+import logging
+from collections import OrderedDict
+from . import metrics
+from .synccache import migrate
+logger = logging.getLogger(__name__)
+
+# Cache of iMIS FindByUserName/Party results for the login path.
+# In-process LRU in front of a table in cache.sqlite so all passenger processes share entries.
+# The tables are created by synccache.MIGRATIONS.
+LOGINCACHE_ROW = "INSERT OR REPLACE INTO logincache VALUES(:key, :partyid, :expires, :json)"
+LOGINCACHE_SELECT = "SELECT * FROM logincache WHERE key=?;"
+LOGINCACHE_DELETE = "DELETE FROM logincache WHERE partyid=?;"
+LOGINCACHE_EXPIRE = "DELETE FROM logincache WHERE expires<?;"
+LOGINGEN_SELECT = "SELECT generation FROM logingen WHERE rowid=1;"
+LOGINGEN_BUMP = "UPDATE logingen SET generation=generation+1 WHERE rowid=1;"
+
+def userKey(username): return f"user:{username}"
+def partyKey(partyid): return f"party:{partyid}"
+
+class LoginCache:
+    def __init__(self, config, dbpath):
+        self.ttl = config.get("LOGIN_CACHE_TIME", 900)
+        self.maxsize = config.get("LOGIN_CACHE_SIZE", 1024)
+        self.entries = OrderedDict() # key: (expires, partyid, data)
+        self.generation = None # logingen when entries were last checked
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        # flask may serve requests from several threads
+        self.db = sqlite3.connect(dbpath, check_same_thread=False, timeout=config.get("SQLITE_BUSY_TIMEOUT", 30))
+        self.db.row_factory = sqlite3.Row
+        migrate(self.db)
+        self.db.execute(LOGINCACHE_EXPIRE, (time.time(),))
+        self.db.commit()
+
+    def checkGeneration(self):
+        # every invalidation in any process bumps logingen. Other writes to cache.sqlite (the sync task
+        # writes all the time) leave it alone, so the in-memory entries survive those.
+        generation = self.db.execute(LOGINGEN_SELECT).fetchone()[0]
+        if generation != self.generation:
+            self.entries.clear()
+            self.generation = generation
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            self.checkGeneration()
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < now:
+                # not loaded or stale, another process may have a fresher one in the shared table.
+                row = self.db.execute(LOGINCACHE_SELECT, (key,)).fetchone()
+                if row is not None:
+                    entry = (row["expires"], row["partyid"], json.loads(row["json"]))
+                    self.remember(key, entry)
+                else: self.entries.pop(key, None)
+            if entry is None or entry[0] < now:
+                self.misses += 1
+                metrics.inc("login_cache_requests_total", result="miss")
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            metrics.inc("login_cache_requests_total", result="hit")
+            return entry[2]
+
+    def put(self, key, partyid, data):
+        expires = time.time() + self.ttl
+        with self.lock:
+            self.checkGeneration()
+            self.db.execute(LOGINCACHE_ROW, (key, partyid, expires, json.dumps(data)))
+            self.db.commit()
+            self.remember(key, (expires, partyid, data))
+
+    def remember(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, partyid):
+        logger.debug("Login cache - invalidating %s", partyid)
+        with self.lock:
+            self.checkGeneration()
+            for key in [k for k, e in self.entries.items() if e[1] == partyid]:
+                del self.entries[key]
+            self.db.execute(LOGINCACHE_DELETE, (partyid,))
+            self.db.execute(LOGINGEN_BUMP)
+            generation = self.db.execute(LOGINGEN_SELECT).fetchone()[0]
+            self.db.commit()
+            # only our own bump since the last check, what is left in memory is still good.
+            if generation == self.generation + 1: self.generation = generation
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}
+
+    def getUserData(self, username, lookup):
+        data = self.get(userKey(username))
+        if data is None:
+            data = lookup()
+            # don't hold on to anonymous results, the user may not have finished signing up.
+            if not data["IsAnonymous"]: self.put(userKey(username), data["UserId"], data)
+        return data
+
+    def getProfileData(self, partyid, lookup):
+        data = self.get(partyKey(partyid))
+        if data is None:
+            data = lookup()
+            self.put(partyKey(partyid), partyid, data)
+        return data
+
+_caches = {} # dbpath: LoginCache
+_pid = None
+
+def getLoginCache(config, dbpath):
+    # one per process and database, sqlite connections must not cross a fork.
+    global _pid
+    if _pid != os.getpid():
+        _caches.clear()
+        _pid = os.getpid()
+    if dbpath not in _caches: _caches[dbpath] = LoginCache(config, dbpath)
+    return _caches[dbpath]
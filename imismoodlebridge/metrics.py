@@ -0,0 +1,144 @@
+import os
+import time
+import pstats
+import cProfile
+import threading
+import contextlib
+import logging
+logger = logging.getLogger(__name__)
+
+# Counters, gauges and latency histograms kept in memory per process, rendered as Prometheus text.
+# Synctask processes store snapshots in cache.sqlite (CacheDB.saveMetrics) so the receiver's
+# "stats" command and the flask /metrics route can show them merged. Snapshots of processes long gone
+# are folded into one "retired" snapshot (CacheDB.retireMetrics).
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def labelKey(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {} # (name, labels): value
+        self.gauges = {}
+        self.histograms = {} # (name, labels): [count per bucket..., +Inf, sum]
+
+    def inc(self, name, value=1, **labels):
+        key = (name, labelKey(labels))
+        with self.lock: self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock: self.gauges[(name, labelKey(labels))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, labelKey(labels))
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None: hist = self.histograms[key] = [0]*(len(BUCKETS)+2)
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    hist[i] += 1
+                    break
+            else: hist[len(BUCKETS)] += 1
+            hist[-1] += value
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.monotonic()
+        try: yield
+        finally: self.observe(name, time.monotonic() - start, **labels)
+
+    def snapshot(self):
+        # json friendly copy
+        with self.lock:
+            return {kind: [[name, list(map(list, labels)), value if kind != "histograms" else list(value)]
+                    for (name, labels), value in getattr(self, kind).items()]
+                for kind in ("counters", "gauges", "histograms")}
+
+def merge(snapshots):
+    # Add up snapshots from several processes. Gauges are a reading of now, so each role (receiver, worker,
+    # from the snapshot's "holder") only counts its newest snapshot's. Summing them would count every
+    # receiver a cron run started within METRICS_MAX_AGE.
+    merged = {"counters": {}, "gauges": {}, "histograms": {}}
+    newest = {} # role: snapshot
+    for snapshot in snapshots:
+        role = snapshot.get("holder", "").split("-")[0]
+        if role not in newest or snapshot.get("updated", 0) >= newest[role].get("updated", 0): newest[role] = snapshot
+        for kind in ("counters", "histograms"):
+            add(merged[kind], kind, snapshot.get(kind, []))
+    for snapshot in newest.values():
+        add(merged["gauges"], "gauges", snapshot.get("gauges", []))
+    return merged
+
+def add(items, kind, values):
+    for name, labels, value in values:
+        key = (name, tuple(map(tuple, labels)))
+        if kind == "histograms":
+            current = items.setdefault(key, [0]*len(value))
+            for i, v in enumerate(value): current[i] += v
+        else: items[key] = items.get(key, 0) + value
+
+def retire(snapshots):
+    # counters and histograms of snapshots about to be deleted, as one snapshot to keep in their place
+    merged = merge(snapshots)
+    return {kind: [[name, list(map(list, labels)), value] for (name, labels), value in merged[kind].items()]
+        for kind in ("counters", "histograms")}
+
+def formatLabels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels: return ""
+    return "{" + ",".join(f'{k}="{str(v)}"' for k, v in labels) + "}"
+
+def render(merged):
+    lines = []
+    for kind, promtype in (("counters", "counter"), ("gauges", "gauge")):
+        typed = set()
+        for (name, labels), value in sorted(merged[kind].items()):
+            if name not in typed:
+                lines.append(f"# TYPE {name} {promtype}")
+                typed.add(name)
+            lines.append(f"{name}{formatLabels(labels)} {value}")
+    typed = set()
+    for (name, labels), hist in sorted(merged["histograms"].items()):
+        if name not in typed:
+            lines.append(f"# TYPE {name} histogram")
+            typed.add(name)
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ("+Inf",), hist[:-1]):
+            cumulative += count
+            lines.append(f"{name}_bucket{formatLabels(labels, (('le', bound),))} {cumulative}")
+        lines.append(f"{name}_sum{formatLabels(labels)} {hist[-1]}")
+        lines.append(f"{name}_count{formatLabels(labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+_registry = None
+_pid = None
+
+def getRegistry():
+    # counts from before a fork belong to the parent
+    global _registry, _pid
+    if _registry is None or _pid != os.getpid():
+        _registry = Registry()
+        _pid = os.getpid()
+    return _registry
+
+def inc(name, value=1, **labels): getRegistry().inc(name, value, **labels)
+def gauge(name, value, **labels): getRegistry().set(name, value, **labels)
+def observe(name, value, **labels): getRegistry().observe(name, value, **labels)
+def timer(name, **labels): return getRegistry().timer(name, **labels)
+
+@contextlib.contextmanager
+def profiled(name, directory, mintime=0):
+    # cProfile one task, saved as <directory>/<name>-<pid>-<time>.prof if it took at least mintime seconds.
+    # Look at it with: python -m pstats file.prof
+    profile = cProfile.Profile()
+    start = time.monotonic()
+    profile.enable()
+    try: yield
+    finally:
+        profile.disable()
+        if time.monotonic() - start >= mintime:
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, f"{name}-{os.getpid()}-{int(time.time())}.prof")
+            pstats.Stats(profile).dump_stats(path)
+            logger.debug("Profile written to %s", path)
@@ -0,0 +1,161 @@
+import json
+import codecs
+import logging
+from typing import NamedTuple
+from .httpclient import getSession
+from . import metrics
+logger = logging.getLogger(__name__)
+
+# Moodle REST web service client, JSON responses.
+STREAM_CHUNK = 64*1024
+# what a number may still go on with at the end of a chunk: "12" of "12.5", "1." of "1.5", "1e" of "1e-3"
+NUMBER_CHARS = frozenset("0123456789+-.eE")
+
+class MoodleError(Exception):
+    def __init__(self, wsfunction, errorcode, message, debuginfo=None):
+        super().__init__(f"{wsfunction}: {errorcode} - {message}")
+        self.wsfunction = wsfunction
+        self.errorcode = errorcode
+        self.message = message
+        self.debuginfo = debuginfo
+
+class MoodleUser(NamedTuple):
+    id: int
+    username: str
+    email: str
+
+def flattenParams(params, prefix=""):
+    # {"users": [{"username": "x"}]} -> [("users[0][username]", "x")], the way moodle wants it.
+    items = []
+    if isinstance(params, dict): pairs = params.items()
+    elif isinstance(params, (list, tuple)): pairs = enumerate(params)
+    else: return [(prefix, params)]
+    for key, value in pairs:
+        items.extend(flattenParams(value, f"{prefix}[{key}]" if prefix else str(key)))
+    return items
+
+def checkResult(wsfunction, result):
+    # moodle reports errors with a 200 and an exception object
+    if isinstance(result, dict) and "exception" in result:
+        metrics.inc("moodle_errors_total", wsfunction=wsfunction, errorcode=result.get("errorcode"))
+        raise MoodleError(wsfunction, result.get("errorcode"), result.get("message"), result.get("debuginfo"))
+    return result
+
+def decodeResponse(wsfunction, text):
+    return checkResult(wsfunction, json.loads(text) if text.strip() else None)
+
+def iterJSONArray(wsfunction, chunks):
+    # Yields the items of a top level JSON array as they arrive instead of holding the whole
+    # response. Anything else (error object, null, single object) is decoded in one go.
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    buf = ""
+    pos = 0
+    eof = False
+    def more():
+        nonlocal buf, pos, eof
+        try:
+            buf = buf[pos:] + next(chunks)
+            pos = 0
+        except StopIteration:
+            eof = True
+    def skip(chars):
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in chars: pos += 1
+            if pos < len(buf) or eof: return
+            more()
+    skip(" \t\r\n")
+    if pos >= len(buf) or buf[pos] != "[":
+        while not eof: more()
+        result = decodeResponse(wsfunction, buf[pos:])
+        if isinstance(result, list): yield from result
+        elif result is not None: yield result
+        return
+    pos += 1
+    while True:
+        skip(" \t\r\n,")
+        if pos >= len(buf): raise ValueError(f"{wsfunction}: truncated JSON response")
+        if buf[pos] == "]": return
+        try:
+            item, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            if eof: raise
+            more()
+            continue
+        number = isinstance(item, (int, float)) and not isinstance(item, bool)
+        if not eof and (end == len(buf) or number and NUMBER_CHARS.issuperset(buf[end:])):
+            # might be a number/literal cut off at the chunk boundary
+            more()
+            continue
+        pos = end
+        yield item
+
+class MoodleClient:
+    def __init__(self, url, token, session=None):
+        self.url = f"{url}/webservice/rest/server.php"
+        self.token = token
+        self.session = session
+
+    def post(self, wsfunction, params, stream=False):
+        data = [("wstoken", self.token), ("wsfunction", wsfunction), ("moodlewsrestformat", "json")]
+        data.extend(flattenParams(params or {}))
+        session = self.session or getSession()
+        try:
+            with metrics.timer("moodle_request_seconds", wsfunction=wsfunction):
+                response = session.post(self.url, data=data, stream=stream)
+                response.raise_for_status()
+        except Exception:
+            metrics.inc("moodle_errors_total", wsfunction=wsfunction, errorcode="http")
+            raise
+        return response
+
+    def call(self, wsfunction, params=None):
+        return decodeResponse(wsfunction, self.post(wsfunction, params).text)
+
+    def iterCall(self, wsfunction, params=None):
+        response = self.post(wsfunction, params, stream=True)
+        utf8 = codecs.getincrementaldecoder("utf-8")()
+        try:
+            yield from iterJSONArray(wsfunction,
+                (utf8.decode(chunk) for chunk in response.iter_content(STREAM_CHUNK)))
+        finally:
+            response.close()
+
+    def getUsersByField(self, field, values):
+        for user in self.iterCall("core_user_get_users_by_field", {"field": field, "values": list(values)}):
+            yield MoodleUser(user["id"], user["username"], user.get("email"))
+
+    def createUsers(self, users):
+        # returns [(id, username)]
+        result = self.call("core_user_create_users", {"users": list(users)})
+        return [(user["id"], user["username"]) for user in result]
+
+    def enrolUsers(self, enrolments):
+        # enrolments: [{"roleid": .., "userid": .., "courseid": ..}]
+        self.call("enrol_manual_enrol_users", {"enrolments": list(enrolments)})
+
+    def unenrolUsers(self, enrolments):
+        self.call("enrol_manual_unenrol_users", {"enrolments": list(enrolments)})
+
+    def requestLoginURL(self, wsfunction, user):
+        return self.call(wsfunction, {"user": user})["loginurl"]
+
+# send(batch) returns False when moodle rejected the batch. A rejected batch is split in half
+# and retried until the offending items are isolated. Returns the list of bad items.
+def bisectBatches(items, batchsize, send, stats):
+    bad = []
+    pending = [items[i:i+batchsize] for i in range(0, len(items), batchsize)]
+    pending.reverse()
+    while pending:
+        batch = pending.pop()
+        stats["calls"] += 1
+        if send(batch): continue
+        if len(batch) == 1:
+            bad.append(batch[0])
+            continue
+        mid = len(batch)//2
+        pending.append(batch[mid:])
+        pending.append(batch[:mid])
+    stats["isolated"] += len(bad)
+    return bad
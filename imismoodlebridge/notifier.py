@@ -0,0 +1,87 @@
+import os
+import time
+import queue
+import socket
+import sqlite3
+import threading
+import logging
+from .synccache import PENDINGUSER_ROW
+log = logging.getLogger()
+
+# Sends iMIS IDs to synctask's receiver without making the request wait on it.
+# IDs are queued and written by a background thread over one persistent connection,
+# newline delimited so several can go in one write. While synctask isn't running they go
+# to pendinguser in cache.sqlite instead, which the receiver queues when it starts.
+
+class SyncNotifier:
+    def __init__(self, socketpath, maxqueue=10000, dbpath=None):
+        self.socketpath = socketpath
+        self.dbpath = dbpath or os.path.join(os.path.dirname(socketpath), "cache.sqlite")
+        self.queue = queue.Queue(maxqueue)
+        self.sock = None
+        self.lasterror = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def notify(self, imisid):
+        try: self.queue.put_nowait(imisid)
+        except queue.Full: log.error("Synctask notification queue full, dropping %s", imisid)
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socketpath)
+
+    def close(self):
+        if self.sock is not None: self.sock.close()
+        self.sock = None
+
+    def send(self, data):
+        # a receiver restart leaves us with a dead connection, so reconnect and try once more
+        for attempt in range(2):
+            try:
+                if self.sock is None: self.connect()
+                self.sock.sendall(data)
+                return True
+            except (FileNotFoundError, ConnectionRefusedError):
+                self.close()
+                break
+            except OSError:
+                self.close()
+        return False
+
+    def store(self, ids):
+        try:
+            db = sqlite3.connect(self.dbpath, timeout=30)
+            try:
+                t = time.time()
+                db.executemany(PENDINGUSER_ROW, ((i, t) for i in ids))
+                db.commit()
+            finally: db.close()
+            return True
+        except sqlite3.Error as e:
+            log.error("Could not store synctask notifications, dropping %s: %s", ids, e)
+            return False
+
+    def run(self):
+        while True:
+            ids = [self.queue.get()]
+            while True:
+                try: ids.append(self.queue.get_nowait())
+                except queue.Empty: break
+            if not self.send("".join(f"{i}\n" for i in ids).encode()):
+                self.store(ids)
+                # don't flood the log during a login storm
+                if time.time() - self.lasterror > 60:
+                    log.error("Socket not found, synctask not running. Check cron. Updates are kept until it starts.")
+                    self.lasterror = time.time()
+
+_notifier = None
+_pid = None
+
+def getNotifier(socketpath):
+    # threads don't survive a fork, one per process.
+    global _notifier, _pid
+    if _notifier is None or _pid != os.getpid():
+        _notifier = SyncNotifier(socketpath)
+        _pid = os.getpid()
+    return _notifier
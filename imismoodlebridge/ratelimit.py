@@ -0,0 +1,101 @@
+import time
+import sqlite3
+import threading
+import logging
+from . import metrics
+logger = logging.getLogger(__name__)
+
+# Request rate and circuit breaker per backend ("imis", "moodle"), shared by every synctask process
+# through one row per backend in cache.sqlite (the ratelimit table, see synccache.MIGRATIONS).
+# The rate follows AIMD: it grows by RATE_INCREASE requests/second every second since the last
+# slow (over RATE_SLOW seconds) or failed (429/5xx/connection error) request, and each of those
+# multiplies it by RATE_DECREASE. BREAKER_FAILURES failures in a row open the breaker for
+# BREAKER_COOLDOWN seconds. Calls then raise BackendUnavailable straight away so tasks can be
+# parked instead of piling onto a backend that is down. Any success closes it again.
+# Only failures and slow calls write the rate, successes just spend a token.
+
+RATELIMIT_ROW = "INSERT OR IGNORE INTO ratelimit VALUES(?, ?, ?, ?, ?, 0, 0)"
+RATELIMIT_SELECT = "SELECT * FROM ratelimit WHERE backend=?;"
+RATELIMIT_TOKENS = "UPDATE ratelimit SET tokens=?, updated=? WHERE backend=?;"
+RATELIMIT_SLOWER = "UPDATE ratelimit SET rate=?, decreased=?, failures=?, openuntil=? WHERE backend=?;"
+RATELIMIT_CLOSE = "UPDATE ratelimit SET failures=0, openuntil=0 WHERE backend=?;"
+
+class BackendUnavailable(Exception):
+    def __init__(self, backend, until):
+        super().__init__(f"{backend} unavailable, circuit open for {max(0, until - time.time()):.0f}s")
+        self.backend = backend
+        self.until = until
+
+class RateLimiter:
+    def __init__(self, config, dbpath):
+        self.config = config
+        self.lock = threading.Lock()
+        # used from the lookup and enrolment threads too
+        self.db = sqlite3.connect(dbpath, check_same_thread=False, timeout=config.get("SQLITE_BUSY_TIMEOUT", 30))
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA synchronous=NORMAL;")
+
+    def setting(self, backend, key, default):
+        # e.g. MOODLE_RATE_MAX, falling back to RATE_MAX
+        return self.config.get(f"{backend.upper()}_{key}", self.config.get(key, default))
+
+    def currentRate(self, row, now):
+        rate = row["rate"] + self.setting(row["backend"], "RATE_INCREASE", 1)*(now - row["decreased"])
+        return min(self.setting(row["backend"], "RATE_MAX", 100), rate)
+
+    def read(self, backend, now):
+        row = self.db.execute(RATELIMIT_SELECT, (backend,)).fetchone()
+        if row is None:
+            start = self.setting(backend, "RATE_MAX", 100)
+            self.db.execute(RATELIMIT_ROW, (backend, start, now, start, now))
+            row = self.db.execute(RATELIMIT_SELECT, (backend,)).fetchone()
+        return row
+
+    def acquire(self, backend):
+        # blocks until a request may go out, BackendUnavailable while the breaker is open
+        while True:
+            with self.lock:
+                now = time.time()
+                self.db.execute("BEGIN IMMEDIATE;")
+                try:
+                    row = self.read(backend, now)
+                    if row["openuntil"] > now: raise BackendUnavailable(backend, row["openuntil"])
+                    rate = self.currentRate(row, now)
+                    # up to a second's worth of burst
+                    tokens = min(max(rate, 1), row["tokens"] + rate*(now - row["updated"]))
+                    wait = 0 if tokens >= 1 else (1 - tokens)/rate
+                    self.db.execute(RATELIMIT_TOKENS, (tokens - 1 if tokens >= 1 else tokens, now, backend))
+                finally:
+                    self.db.commit()
+            if not wait: return
+            metrics.inc("ratelimit_waits_total", backend=backend)
+            time.sleep(min(wait, 1))
+
+    def record(self, backend, ok, latency):
+        # returns when the circuit closes again if this failure left it open, else 0
+        slow = latency > self.setting(backend, "RATE_SLOW", 5)
+        with self.lock:
+            now = time.time()
+            row = self.read(backend, now)
+            if ok and not slow:
+                if row["failures"]:
+                    self.db.execute(RATELIMIT_CLOSE, (backend,))
+                    if row["openuntil"]: logger.warning("%s is back, closing circuit.", backend)
+                self.db.commit()
+                return 0
+            self.db.execute("BEGIN IMMEDIATE;")
+            try:
+                row = self.read(backend, now)
+                rate = max(self.setting(backend, "RATE_MIN", 1), self.currentRate(row, now)*self.setting(backend, "RATE_DECREASE", 0.5))
+                failures = 0 if ok else row["failures"] + 1
+                openuntil = row["openuntil"]
+                if failures >= self.setting(backend, "BREAKER_FAILURES", 5) and openuntil <= now:
+                    openuntil = now + self.setting(backend, "BREAKER_COOLDOWN", 30)
+                    logger.warning("%s failing (%s in a row), opening circuit for %ss.", backend, failures, openuntil - now)
+                    metrics.inc("circuit_opened_total", backend=backend)
+                self.db.execute(RATELIMIT_SLOWER, (rate, now, failures, openuntil, backend))
+            finally:
+                self.db.commit()
+            metrics.inc("ratelimit_backoffs_total", backend=backend, reason="slow" if ok else "error")
+            logger.debug("%s %s, rate now %.1f/s", backend, "slow" if ok else "failed", rate)
+            return openuntil if not ok and openuntil > now else 0
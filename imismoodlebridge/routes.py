@@ -1,32 +1,45 @@
 import time
 from flask import Blueprint, jsonify, request, abort
-from flask import redirect, current_app
+from flask import redirect, current_app, Response
 from .imisUtil import getiMISUserData, getiMISTokenData, getiMISProfileData, findEmail
-import requests
+from .moodle import MoodleClient
+from .logincache import getLoginCache
+from .notifier import getNotifier
+from .synccache import loadMetrics
+from . import metrics
 import logging
-import re
-import socket
 import os
 
-GET_LOGIN_URL = re.compile(r"<VALUE>([^<]+)</VALUE>")
-
 log = logging.getLogger()
 bp = Blueprint('oauth2', __name__)
 
+def loginCache():
+    return getLoginCache(current_app.config, os.path.join(current_app.instance_path, "cache.sqlite"))
+
+def notifySynctask(imisid):
+    getNotifier(os.path.join(current_app.instance_path, "socket")).notify(imisid)
+
 @bp.route('/', methods=('GET', 'POST'))
 def home():
     return redirect(current_app.config["HOMEPAGE"])
 
+@bp.route("/metrics", methods=('GET',))
+def showMetrics():
+    # this process plus what the synctask processes last saved. Off unless METRICS_ENABLED.
+    if not current_app.config.get("METRICS_ENABLED", False): abort(404)
+    snapshots = loadMetrics(current_app.config, os.path.join(current_app.instance_path, "cache.sqlite"))
+    snapshots.append(metrics.getRegistry().snapshot())
+    return Response(metrics.render(metrics.merge(snapshots)), mimetype="text/plain; version=0.0.4")
+
 @bp.route("/update/<imisID>", methods=('GET',))
 def updateUser(imisID):
     if len(imisID) > 10:
         # crude attempt to stop overflowing my socket buffer
         return redirect(current_app.config["IMIS_MOODLE_LOGIN_PAGE"])
+    # user details may have changed, don't serve them from the login cache
+    loginCache().invalidate(imisID)
     # send ID to synctask to check for updated course registrations
-    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-    client.connect(os.path.join(current_app.instance_path, "socket"))
-    client.sendall(imisID.encode())
-    client.close()
+    notifySynctask(imisID)
     response = jsonify(success=True)
     response.headers["Access-Control-Allow-Origin"] = current_app.config['HOMEPAGE']
     return response
@@ -59,31 +72,24 @@ def login():
         except KeyError: 
             log.error(f"Invalid setup - Check clientid and secret. Config ClientID: {config_clientid}, Error: {tokendata}.")
             abort(500)
-        imisUserData = getiMISUserData(current_app.config['HOMEPAGE'], tokendata["userName"],
-            clientid, tokendata["access_token"])
+        cache = loginCache()
+        imisUserData = cache.getUserData(tokendata["userName"], lambda: getiMISUserData(
+            current_app.config['HOMEPAGE'], tokendata["userName"], clientid, tokendata["access_token"]))
         if (imisUserData["IsAnonymous"]): return redirect(current_app.config["IMIS_MOODLE_LOGIN_PAGE"])
         
         # get some iMIS user data (first name, last name, email)
-        profiledata = getiMISProfileData(current_app.config['HOMEPAGE'], imisUserData["UserId"], tokendata["access_token"])
-        postdata = {
-            "wstoken": current_app.config["MOODLE_AUTH_TOKEN"],
-            "wsfunction": current_app.config["MOODLE_FUNCTION"],
-            "user[username]": imisUserData["UserId"],
-            "user[firstname]": profiledata["PersonName"]["FirstName"],
-            "user[lastname]": profiledata["PersonName"]["LastName"],
-            "user[email]": findEmail(profiledata),
-        }
-        response = requests.post(f"{current_app.config['MOODLE_URL']}/webservice/rest/server.php",
-            data=postdata).text
+        profiledata = cache.getProfileData(imisUserData["UserId"], lambda: getiMISProfileData(
+            current_app.config['HOMEPAGE'], imisUserData["UserId"], tokendata["access_token"]))
+        moodle = MoodleClient(current_app.config['MOODLE_URL'], current_app.config["MOODLE_AUTH_TOKEN"])
+        loginurl = moodle.requestLoginURL(current_app.config["MOODLE_FUNCTION"], {
+            "username": imisUserData["UserId"],
+            "firstname": profiledata["PersonName"]["FirstName"],
+            "lastname": profiledata["PersonName"]["LastName"],
+            "email": findEmail(profiledata),
+        })
         # send ID to synctask to check for updated course registrations
-        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        try:
-            client.connect(os.path.join(current_app.instance_path, "socket"))
-            client.sendall(imisUserData["UserId"].encode())
-            client.close()
-        except FileNotFoundError:
-            logging.error("Socket not found, synctask not running. Check cron.")
+        notifySynctask(imisUserData["UserId"])
         # redirect to moodle proper.
-        return redirect(GET_LOGIN_URL.search(response).group(1))
+        return redirect(loginurl)
     else:
         return redirect(current_app.config["HOMEPAGE"])
@@ -1,88 +1,376 @@
+import os
 import sqlite3
+import threading
 import json
 import time
+import datetime
 import logging
 from iMISpy import openAPI
+from . import metrics
 logger = logging.getLogger(__name__)
 
 # use implied rowid
 TABLE = {
-    "PANELSOURCE" : "CREATE TABLE panelsource(rowid INTEGER PRIMARY KEY, expires REAL, json TEXT)",
-    "USERUPDATE" : "CREATE TABLE userupdate(imisid INTEGER PRIMARY KEY, expires REAL)",
-    "FULLSYNC" : "CREATE TABLE fullsync(rowid INTEGER PRIMARY KEY, expires REAL)"
+    "PANELSOURCE" : "CREATE TABLE IF NOT EXISTS panelsource(rowid INTEGER PRIMARY KEY, expires REAL, json TEXT)",
+    "USERUPDATE" : "CREATE TABLE IF NOT EXISTS userupdate(imisid INTEGER PRIMARY KEY, expires REAL)",
+    "FULLSYNC" : "CREATE TABLE IF NOT EXISTS fullsync(rowid INTEGER PRIMARY KEY, expires REAL)",
+    "BADUSER" : "CREATE TABLE IF NOT EXISTS baduser(username TEXT PRIMARY KEY, expires REAL)",
+    "MOODLEUSER" : "CREATE TABLE IF NOT EXISTS moodleuser(imisid TEXT PRIMARY KEY, moodleid TEXT)",
+    "ENROLSNAPSHOT" : "CREATE TABLE IF NOT EXISTS enrolsnapshot(courseid TEXT, imisid TEXT, synced REAL, PRIMARY KEY(courseid, imisid))",
+    "PENDINGUSER" : "CREATE TABLE IF NOT EXISTS pendinguser(imisid TEXT PRIMARY KEY, queued REAL)",
+    "PANELLEASE" : "CREATE TABLE IF NOT EXISTS panellease(rowid INTEGER PRIMARY KEY, holder INTEGER, expires REAL)",
+    "PANELGROUP" : "CREATE TABLE IF NOT EXISTS panelgroup(groupid TEXT PRIMARY KEY, code TEXT, refreshed REAL)",
+    "PANELMAP" : "CREATE TABLE IF NOT EXISTS panelmap(groupid TEXT PRIMARY KEY, courses TEXT, imiscode TEXT)",
+    "STAGEMEMBER" : "CREATE TABLE IF NOT EXISTS stagemember(courseid TEXT, imisid TEXT, PRIMARY KEY(courseid, imisid))",
+    "STAGEUSER" : "CREATE TABLE IF NOT EXISTS stageuser(imisid TEXT PRIMARY KEY, email TEXT)",
+    "SYNCJOB" : "CREATE TABLE IF NOT EXISTS syncjob(id INTEGER PRIMARY KEY AUTOINCREMENT, stage INTEGER, data TEXT, claimed REAL, done INTEGER)",
+    "METRICS" : "CREATE TABLE IF NOT EXISTS metrics(holder TEXT PRIMARY KEY, updated REAL, json TEXT)",
+    "RATELIMIT" : "CREATE TABLE IF NOT EXISTS ratelimit(backend TEXT PRIMARY KEY, tokens REAL, updated REAL, rate REAL, decreased REAL, failures INTEGER, openuntil REAL)",
+    "SYNCRUN" : "CREATE TABLE IF NOT EXISTS syncrun(owner TEXT PRIMARY KEY, heartbeat REAL)",
+    "LOGINCACHE" : "CREATE TABLE IF NOT EXISTS logincache(key TEXT PRIMARY KEY, partyid TEXT, expires REAL, json TEXT)",
+    "LOGINGEN" : "CREATE TABLE IF NOT EXISTS logingen(rowid INTEGER PRIMARY KEY, generation INTEGER)"
 }
+INDEX = (
+    "CREATE INDEX IF NOT EXISTS panelgroup_code ON panelgroup(code)",
+)
+# PRAGMA user_version is the number of these applied. Append only, never edit a released step.
+MIGRATIONS = (
+    # 1: tables up to resumable full syncs. Older trees probed sqlite_master and created whatever was
+    # missing, so they may have any subset. stageuser gained a column, it only holds one sync's staging.
+    ("DROP TABLE IF EXISTS stageuser;", *(TABLE[name] for name in ("PANELSOURCE", "USERUPDATE", "FULLSYNC", "BADUSER",
+        "MOODLEUSER", "ENROLSNAPSHOT", "PENDINGUSER", "PANELLEASE", "PANELGROUP", "PANELMAP", "STAGEMEMBER", "STAGEUSER",
+        "SYNCJOB")), *INDEX),
+    # 2: expiry sweeps
+    ("CREATE INDEX IF NOT EXISTS userupdate_expires ON userupdate(expires)",
+     "CREATE INDEX IF NOT EXISTS baduser_expires ON baduser(expires)"),
+    # 3: metrics snapshots from synctask processes
+    (TABLE["METRICS"],),
+    # 4: shared rate limits and circuit breakers, see ratelimit.py
+    (TABLE["RATELIMIT"],),
+    # 5: which sync task run holds each claimed job, so an overlapping run leaves them alone
+    ("ALTER TABLE syncjob ADD COLUMN owner TEXT", TABLE["SYNCRUN"]),
+    # 6: login cache, see logincache.py. Older trees created the table on the fly. The generation is bumped
+    # on every invalidation so each process knows when to drop its in-memory copies.
+    (TABLE["LOGINCACHE"], "CREATE INDEX IF NOT EXISTS logincache_partyid ON logincache(partyid)", TABLE["LOGINGEN"],
+     "INSERT OR IGNORE INTO logingen VALUES(1, 0)"),
+    # 7: how many times each full sync unit has failed, see failSyncJob
+    ("ALTER TABLE syncjob ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0",),
+    # 8: which worker (pid) of the owning run holds each claimed job, so one that dies can be released alone
+    ("ALTER TABLE syncjob ADD COLUMN worker INTEGER",),
+)
 # This MUST be in table create order (probably)...
 PANELSOURCE_ROW = "INSERT OR REPLACE INTO panelsource VALUES(:rowid, :expires, :json)"
 USERUPDATE_ROW = "INSERT OR REPLACE INTO userupdate VALUES(:imisid, :expires)"
 FULLSYNC_ROW = "INSERT OR REPLACE INTO fullsync VALUES(:rowid, :expires)"
+BADUSER_ROW = "INSERT OR REPLACE INTO baduser VALUES(:username, :expires)"
+MOODLEUSER_ROW = "INSERT OR REPLACE INTO moodleuser VALUES(:imisid, :moodleid)"
+MOODLEUSER_DELETE = "DELETE FROM moodleuser WHERE imisid=?;"
+ENROLSNAPSHOT_FORGET = "DELETE FROM enrolsnapshot WHERE imisid=?;"
+ENROLSNAPSHOT_ROW = "INSERT OR REPLACE INTO enrolsnapshot VALUES(:courseid, :imisid, :synced)"
+ENROLSNAPSHOT_DELETE = "DELETE FROM enrolsnapshot WHERE courseid=? AND imisid=?;"
+PENDINGUSER_ROW = "INSERT OR IGNORE INTO pendinguser VALUES(:imisid, :queued)"
+PENDINGUSER_SELECT = "SELECT imisid FROM pendinguser WHERE queued<? ORDER BY queued;"
+PENDINGUSER_DELETE = "DELETE FROM pendinguser WHERE imisid=?;"
+PANELLEASE_ROW = "INSERT OR REPLACE INTO panellease VALUES(:rowid, :holder, :expires)"
+PANELLEASE_DELETE = "DELETE FROM panellease WHERE rowid=1 AND holder=?;"
+PANELGROUP_ROW = "INSERT OR REPLACE INTO panelgroup VALUES(:groupid, :code, :refreshed)"
+PANELGROUP_EXPIRE = "DELETE FROM panelgroup WHERE refreshed<?;"
+# panel source rows, only kept for the duration of a refresh
+PANELROW_TABLE = "CREATE TEMP TABLE IF NOT EXISTS panelrow(imiscode TEXT, courses TEXT)"
+PANELROW_ROW = "INSERT INTO panelrow VALUES(?, ?)"
+PANELMAP_REBUILD = """INSERT OR REPLACE INTO panelmap SELECT panelgroup.groupid, panelrow.courses, panelrow.imiscode
+    FROM panelrow JOIN panelgroup ON panelgroup.code=panelrow.imiscode;"""
+# full sync staging, memberships of all mapped courses and the users seen so far
+STAGEMEMBER_ROW = "INSERT OR IGNORE INTO stagemember VALUES(:courseid, :imisid)"
+STAGEUSER_ROW = "INSERT OR IGNORE INTO stageuser VALUES(:imisid, :email)"
+STAGEUSER_SELECT = "SELECT * FROM stageuser WHERE imisid IN ({});"
+STAGEMEMBER_ADDED = """SELECT imisid FROM stagemember WHERE courseid=? AND imisid NOT IN
+    (SELECT imisid FROM enrolsnapshot WHERE courseid=? AND synced>?);"""
+STAGEMEMBER_REMOVED = """SELECT imisid FROM enrolsnapshot WHERE courseid=? AND imisid NOT IN
+    (SELECT imisid FROM stagemember WHERE courseid=?);"""
+# full sync work units. A unit can only be claimed once every unit of the earlier stages is done.
+SYNCJOB_ROW = "INSERT INTO syncjob(stage, data, claimed, done) VALUES(?, ?, NULL, 0)"
+SYNCJOB_CLAIM = """SELECT * FROM syncjob WHERE done=0 AND (claimed IS NULL OR claimed<?)
+    AND stage=(SELECT MIN(stage) FROM syncjob WHERE done=0) ORDER BY id LIMIT 1;"""
+SYNCJOB_CLAIMED = "UPDATE syncjob SET claimed=? WHERE id=?;"
+SYNCJOB_OWNED = "UPDATE syncjob SET claimed=?, owner=?, worker=? WHERE id=?;"
+SYNCJOB_DONE = "UPDATE syncjob SET done=1 WHERE id=?;"
+SYNCJOB_FAILED = "UPDATE syncjob SET claimed=?, attempts=attempts+1 WHERE id=?;"
+SYNCJOB_ATTEMPTS = "SELECT attempts FROM syncjob WHERE id=?;"
+SYNCJOB_PENDING = "SELECT COUNT(*) FROM syncjob WHERE done=0;"
+SYNCJOB_RELEASE = """UPDATE syncjob SET claimed=NULL, owner=NULL, worker=NULL WHERE done=0
+    AND (owner IS NULL OR owner NOT IN (SELECT owner FROM syncrun WHERE heartbeat>=?));"""
+SYNCJOB_RELEASE_OWNER = "UPDATE syncjob SET claimed=NULL, owner=NULL, worker=NULL WHERE done=0 AND owner=?;"
+SYNCJOB_RELEASE_WORKER = "UPDATE syncjob SET claimed=NULL, owner=NULL, worker=NULL WHERE done=0 AND owner=? AND worker=?;"
+SYNCRUN_ROW = "INSERT OR REPLACE INTO syncrun VALUES(?, ?)"
+SYNCRUN_EXPIRE = "DELETE FROM syncrun WHERE heartbeat<?;"
+SYNCRUN_DELETE = "DELETE FROM syncrun WHERE owner=?;"
 # select...
 PANELSOURCE_SELECT = "SELECT * FROM panelsource WHERE rowid=1;"
+PANELSOURCE_VERSION = "SELECT expires FROM panelsource WHERE rowid=1;"
+PANELLEASE_SELECT = "SELECT * FROM panellease WHERE rowid=1;"
+PANELMAP_SELECT = "SELECT * FROM panelmap;"
 USERUPDATE_SELECT = "SELECT * FROM userupdate WHERE imisid=?;"
+USERUPDATE_EXPIRE = "DELETE FROM userupdate WHERE expires<?;"
+# IDs to check against userupdate in one join, only kept for the duration of filterExpired
+USERCHECK_TABLE = "CREATE TEMP TABLE IF NOT EXISTS usercheck(imisid TEXT PRIMARY KEY)"
+USERCHECK_ROW = "INSERT OR IGNORE INTO usercheck VALUES(?)"
+USERCHECK_EXPIRED = """SELECT usercheck.imisid FROM usercheck LEFT JOIN userupdate ON userupdate.imisid=usercheck.imisid
+    WHERE userupdate.expires IS NULL OR userupdate.expires<?;"""
+BADUSER_EXPIRE = "DELETE FROM baduser WHERE expires<?;"
+METRICS_ROW = "INSERT OR REPLACE INTO metrics VALUES(:holder, :updated, :json)"
+METRICS_SELECT = "SELECT * FROM metrics;"
+METRICS_OLD = "SELECT * FROM metrics WHERE updated<? AND holder!='retired';"
+METRICS_EXPIRE = "DELETE FROM metrics WHERE updated<? AND holder!='retired';"
+METRICS_RETIRED = "SELECT * FROM metrics WHERE holder='retired';"
 FULLSYNC_SELECT = "SELECT * FROM fullsync WHERE rowid=1;"
+BADUSER_SELECT = "SELECT username FROM baduser WHERE expires>?;"
+MOODLEUSER_SELECT = "SELECT * FROM moodleuser WHERE imisid IN ({});"
+# sqlite has a limit on bound parameters per statement
+SELECT_CHUNK = 500
+# full sync stages, a stage starts when every job of the one before is done
+STAGE_GATHER = 1 # page a few groups, stage memberships, resolve new users
+STAGE_ENROL = 2 # enrol one course
+STAGE_FINISH = 3
+
+def updatedSince(newest, since=None):
+    # Marker for the next incremental panel refresh, in iMIS time: the newest group UpdatedOn seen so far,
+    # less some slop for edits still in flight. Only if iMIS sent none at all is our own clock used.
+    if newest:
+        stamp = datetime.datetime.strptime(newest[:19], "%Y-%m-%dT%H:%M:%S") - datetime.timedelta(minutes=5)
+        return max(since or "", stamp.strftime("%Y-%m-%dT%H:%M:%S"))
+    if since: return since
+    return (datetime.datetime.now() - datetime.timedelta(minutes=5)).strftime("%Y-%m-%dT%H:%M:%S")
+
+def migrate(db):
+    # bring any connection to cache.sqlite up to date, whichever process opens it first.
+    if db.execute("PRAGMA user_version;").fetchone()[0] >= len(MIGRATIONS): return
+    db.execute("BEGIN IMMEDIATE;")
+    try:
+        # another process may have got here first
+        version = db.execute("PRAGMA user_version;").fetchone()[0]
+        for step in range(version, len(MIGRATIONS)):
+            logger.debug("Cache - migrating schema to version %s", step+1)
+            for statement in MIGRATIONS[step]: db.execute(statement)
+        db.execute(f"PRAGMA user_version={len(MIGRATIONS)};")
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
 
 class CacheDB:
-    def __init__(self, config, dbpath):
+    def __init__(self, config, dbpath, shared=False):
         logger.setLevel(config.get("LOG_LEVEL", "WARN"))
-        self.db = sqlite3.connect(dbpath)
+        # every worker, the receiver and the flask processes share this file. WAL lets readers carry on
+        # during a write, and writers wait for each other instead of failing with "database is locked".
+        # shared: used from several threads, the caller serialises access.
+        self.db = sqlite3.connect(dbpath, check_same_thread=not shared, timeout=config.get("SQLITE_BUSY_TIMEOUT", 30))
+        self.dbpath = dbpath
         self.paneldata = None
+        self.panelchecked = 0
+        self.refresher = None
         self.config = config
+        self.userupdates = {} # imisid: expires, not written yet
+        self.finished = set() # pendinguser rows to delete
+        self.flushed = time.time()
         self.db.row_factory = sqlite3.Row
-        # check if tables exist:
-        for table in ("panelsource", "userupdate", "fullsync"):    
-            res = self.db.execute(f'''SELECT name FROM sqlite_master WHERE type='table' AND name='{table}';''').fetchone()
-            if res is None:
-                logger.debug(f"{table} Table not found, creating.")
-                self.db.execute(f"{TABLE[table.upper()]}")
-                self.db.commit()
+        self.db.execute("PRAGMA journal_mode=WAL;")
+        self.db.execute("PRAGMA synchronous=NORMAL;")
+        self.migrate()
+
+    def migrate(self):
+        migrate(self.db)
 
     def acquirePanelSourceData(self):
-        # get panel source data
+        # get panel source data. Groups are fetched incrementally (only those changed since the last
+        # refresh) with a full pass every PANEL_FULL_REFRESH_HOURS to drop deleted groups.
         logger.debug("Cache - Refreshing panel data")
-        t = time.time() + (self.config.get("PANEL_CACHE_TIME", 10)*60) - 10 # 10 seconds before
-        imisCodeToGroupID = {}
-        imisGroupIDtoCode = {}
+        now = time.time()
+        t = now + (self.config.get("PANEL_CACHE_TIME", 10)*60) - 10 # 10 seconds before
+        row = self.db.execute(PANELSOURCE_SELECT).fetchone()
+        meta = json.loads(row["json"]) if row is not None else {}
+        full = "since" not in meta or now - meta.get("fullrefresh", 0) > self.config.get("PANEL_FULL_REFRESH_HOURS", 24)*60*60
+        field = self.config.get("iMIS_GROUP_UPDATED_FIELD", "UpdatedOn")
+        changed = [] if full else [[field, f"gt:{meta['since']}"]]
+        groups = []
+        newest = ""
         api = openAPI(self.config)
-        for item in api.apiIterator("Group", [["GroupClassId", "EVENT"] ]):
-            imisCodeToGroupID[item["GroupId"]] = item["GroupId"] # Put Event-<eventcode> Groups IDs as "imis Code"
-            imisGroupIDtoCode[item["GroupId"]] = item["GroupId"]
-        for item in api.apiIterator("Group", [["GroupClassId", self.config.get("iMIS_PURCHASED_PRODUCTS_CLASS_ID", "E88E66B1-9516-47F9-88DC-E2EB8A3EF13E")] ]):
-            imisCodeToGroupID[item["Name"]] = item["GroupId"] # Product purcahse group name -> Group ID
-            imisGroupIDtoCode[item["GroupId"]] = item["Name"]
+        for item in api.apiIterator("Group", [["GroupClassId", "EVENT"]] + changed):
+            groups.append((item["GroupId"], item["GroupId"], now)) # Put Event-<eventcode> Groups IDs as "imis Code"
+            newest = max(newest, item.get(field) or "")
+        for item in api.apiIterator("Group", [["GroupClassId", self.config.get("iMIS_PURCHASED_PRODUCTS_CLASS_ID", "E88E66B1-9516-47F9-88DC-E2EB8A3EF13E")]] + changed):
+            groups.append((item["GroupId"], item["Name"], now)) # Product purcahse group name -> Group ID
+            newest = max(newest, item.get(field) or "")
+        # a full pass starts over, so a marker taken from our clock by older versions doesn't stick
+        since = updatedSince(newest, None if full else meta.get("since"))
+        # the panel source itself is small, always read all of it
+        rows = [(item["IMIS_SIDE"], item["MOODLE_SIDE"])
+            for item in api.apiIterator("query", [["QueryName", self.config["iMIS_PANELSOURCE_IQA"] ]])]
+        logger.debug("Cache - %s refresh, %s groups changed, %s panel rows", "full" if full else "incremental", len(groups), len(rows))
+        # everything fetched, now one short write transaction
+        self.db.execute(PANELROW_TABLE)
+        self.db.executemany(PANELGROUP_ROW, groups)
+        if full:
+            self.db.execute(PANELGROUP_EXPIRE, (now,))
+            meta = {"fullrefresh": now}
+        meta["since"] = since
+        self.db.executemany(PANELROW_ROW, rows)
+        self.db.execute("DELETE FROM panelmap;")
+        self.db.execute(PANELMAP_REBUILD)
+        self.db.execute("DELETE FROM panelrow;")
+        self.db.execute(PANELSOURCE_ROW, (1, t, json.dumps(meta)))
+        self.db.commit()
+        self.paneldata = {"expires": t, "json": self.readPanelMap()}
+        return self.paneldata["json"]
+
+    def readPanelMap(self):
         pd = {}
         pd["CMap"] = {}
         pd["imisgroupcode"] = {} # this isn't used... yet.
-        for item in api.apiIterator("query", [["QueryName", self.config["iMIS_PANELSOURCE_IQA"] ]]):
-            imisside = item["IMIS_SIDE"]
-            moodleside = item["MOODLE_SIDE"]
-            if imisside in imisCodeToGroupID:
-                pd["CMap"][imisCodeToGroupID[imisside]] = moodleside
-                pd["imisgroupcode"][imisCodeToGroupID[imisside]] = imisside
-        self.db.execute(PANELSOURCE_ROW, (1, t, json.dumps(pd)))
-        self.db.commit()
-        self.paneldata = {"expires": t, "json": pd}
+        for row in self.db.execute(PANELMAP_SELECT):
+            pd["CMap"][row["groupid"]] = row["courses"]
+            pd["imisgroupcode"][row["groupid"]] = row["imiscode"]
         return pd
 
+    def tryPanelLease(self):
+        # only one process (the lease holder) refreshes panel data at a time.
+        now = time.time()
+        self.db.execute("BEGIN IMMEDIATE;")
+        try:
+            lease = self.db.execute(PANELLEASE_SELECT).fetchone()
+            if lease is not None and lease["expires"] > now:
+                return False
+            self.db.execute(PANELLEASE_ROW, (1, os.getpid(), now + self.config.get("PANEL_LEASE_TIME", 600)))
+            return True
+        finally:
+            self.db.commit()
+
+    def releasePanelLease(self):
+        self.db.execute(PANELLEASE_DELETE, (os.getpid(),))
+        self.db.commit()
+
+    def refreshPanelSource(self):
+        # runs in its own thread, so needs its own connection.
+        db = CacheDB(self.config, self.dbpath)
+        try: db.acquirePanelSourceData()
+        except Exception as e: logger.error("Cache - panel refresh failed: %s", e, exc_info=True)
+        finally: db.releasePanelLease()
+
+    def close(self, timeout=None):
+        # A panel refresh still running would die with the process and hold the lease (so nobody else
+        # refreshes) for PANEL_LEASE_TIME. Give it timeout seconds to finish, then let go of the lease.
+        if self.refresher is not None and self.refresher.is_alive():
+            logger.debug("Cache - waiting for panel refresh")
+            self.refresher.join(timeout)
+            if self.refresher.is_alive():
+                logger.warning("Cache - panel refresh cut short, releasing lease.")
+                self.releasePanelLease()
+        self.db.close()
+
+    def loadPanelSource(self):
+        # re-read the stored map if another process has refreshed it since we last looked.
+        self.panelchecked = time.time()
+        version = self.db.execute(PANELSOURCE_VERSION).fetchone()
+        if version is None: return
+        if self.paneldata is None or self.paneldata["expires"] != version["expires"]:
+            row = self.db.execute(PANELSOURCE_SELECT).fetchone()
+            # written by an older version as one json blob, needs a (full) refresh
+            if "since" not in json.loads(row["json"]): return
+            self.paneldata = {"expires": version["expires"], "json": self.readPanelMap()}
+
     def getPanelSource(self):
-        if not self.paneldata:
-            self.paneldata = self.db.execute(PANELSOURCE_SELECT).fetchone()
-            if self.paneldata is not None:
-                # weird unpacking...
-                self.paneldata = {"expires": self.paneldata["expires"], "json": json.loads(self.paneldata["json"])}
-        if self.paneldata is None: 
-            return self.acquirePanelSourceData()
-        if self.paneldata["expires"] < time.time():
-            return self.acquirePanelSourceData()
+        if self.paneldata is None or time.time() - self.panelchecked > 1:
+            self.loadPanelSource()
+        if self.paneldata is None: result = "miss"
+        elif self.paneldata["expires"] < time.time(): result = "stale"
+        else: result = "hit"
+        metrics.inc("panel_cache_requests_total", result=result)
+        while self.paneldata is None:
+            # nothing to serve yet, we have to wait for data
+            if self.tryPanelLease():
+                try: return self.acquirePanelSourceData()
+                finally: self.releasePanelLease()
+            logger.debug("Cache - waiting for panel data from another process")
+            time.sleep(1)
+            self.loadPanelSource()
+        if self.paneldata["expires"] < time.time() and not (self.refresher and self.refresher.is_alive()):
+            # serve the stale copy while someone refreshes it
+            if self.tryPanelLease():
+                self.refresher = threading.Thread(target=self.refreshPanelSource, daemon=True)
+                self.refresher.start()
         return self.paneldata["json"]
 
     def updateUser(self, imisid):
-        t = time.time()+self.config.get("USER_CACHE_TIME", 30)
-        self.db.execute(USERUPDATE_ROW, (imisid, t))
-        self.db.commit()
-    
+        # buffered, written by flushUsers in one transaction
+        self.userupdates[imisid] = time.time()+self.config.get("USER_CACHE_TIME", 30)
+        self.maybeFlushUsers()
+
+    def expireUser(self, imisid):
+        # an expired row is as good as none, the sweep removes it
+        self.userupdates[imisid] = 0
+        self.maybeFlushUsers()
+
     def isUserExpired(self, imisid):
-        data = self.db.execute(USERUPDATE_SELECT, (imisid,)).fetchone()
-        if data is None or time.time() > data["expires"]: return True
-        else: return False
+        if imisid in self.userupdates: expired = time.time() > self.userupdates[imisid]
+        else:
+            data = self.db.execute(USERUPDATE_SELECT, (imisid,)).fetchone()
+            expired = data is None or time.time() > data["expires"]
+        metrics.inc("user_cache_requests_total", result="miss" if expired else "hit")
+        return expired
+
+    def filterExpired(self, imisids):
+        # the IDs due an update, for many users at once instead of isUserExpired on each
+        imisids = [str(i) for i in imisids]
+        if not imisids: return []
+        now = time.time()
+        self.db.execute(USERCHECK_TABLE)
+        self.db.executemany(USERCHECK_ROW, ((i,) for i in imisids))
+        expired = {row["imisid"] for row in self.db.execute(USERCHECK_EXPIRED, (now,))}
+        self.db.execute("DELETE FROM usercheck;")
+        self.db.commit()
+        expired = [i for i in imisids if (now > self.userupdates[i] if i in self.userupdates else i in expired)]
+        metrics.inc("user_cache_requests_total", len(expired), result="miss")
+        metrics.inc("user_cache_requests_total", len(imisids) - len(expired), result="hit")
+        return expired
+
+    def maybeFlushUsers(self):
+        pending = len(self.userupdates) + len(self.finished)
+        if pending >= self.config.get("USER_COMMIT_BATCH", 50) or time.time() - self.flushed > self.config.get("USER_COMMIT_TIME", 1):
+            self.flushUsers()
+
+    def flushUsers(self):
+        # one commit for everything the worker has finished since the last flush.
+        # Lost on a crash, which only means those users get processed again.
+        self.flushed = time.time()
+        if not self.userupdates and not self.finished: return
+        self.db.executemany(USERUPDATE_ROW, self.userupdates.items())
+        self.db.executemany(PENDINGUSER_DELETE, ((i,) for i in self.finished))
+        self.db.commit()
+        self.userupdates.clear()
+        self.finished.clear()
+
+    def sweepExpired(self):
+        # userupdate would otherwise grow with every user who ever logged in
+        now = time.time()
+        users = self.db.execute(USERUPDATE_EXPIRE, (now,)).rowcount
+        bad = self.db.execute(BADUSER_EXPIRE, (now,)).rowcount
+        self.db.commit()
+        self.retireMetrics(now - self.config.get("METRICS_MAX_AGE", 60*60))
+        logger.debug("Cache - swept %s user updates, %s bad users", users, bad)
+
+    def retireMetrics(self, before):
+        # Processes gone for a while, restarted workers and every cron run save under a new pid. Their counters
+        # and histograms are added to the "retired" row before their snapshots go, so totals never go down.
+        self.db.execute("BEGIN IMMEDIATE;")
+        try:
+            old = [json.loads(row["json"]) for row in self.db.execute(METRICS_OLD, (before,))]
+            if not old: return
+            retired = self.db.execute(METRICS_RETIRED).fetchone()
+            if retired is not None: old.append(json.loads(retired["json"]))
+            self.db.execute(METRICS_ROW, ("retired", time.time(), json.dumps(metrics.retire(old))))
+            self.db.execute(METRICS_EXPIRE, (before,))
+        finally:
+            self.db.commit()
     
     def updateFullSync(self):
         # don't allow another full sync within this amount of time (2 hours)
@@ -94,3 +382,226 @@ class CacheDB:
         data = self.db.execute(FULLSYNC_SELECT).fetchone()
         if data is None or time.time() > data["expires"]: return True
         else: return False
+
+    def addBadUsers(self, usernames):
+        # users moodle refuses to create, don't retry them for a day
+        t = time.time()+self.config.get("BAD_USER_CACHE_TIME", 60*60*24)
+        self.db.executemany(BADUSER_ROW, ((u, t) for u in usernames))
+        self.db.commit()
+
+    def getBadUsers(self):
+        return {row["username"] for row in self.db.execute(BADUSER_SELECT, (time.time(),))}
+
+    def getMoodleIDs(self, imisids):
+        # iMIS ID -> moodle user id, for users we've already resolved.
+        imisids = list(imisids)
+        found = {}
+        for i in range(0, len(imisids), SELECT_CHUNK):
+            chunk = imisids[i:i+SELECT_CHUNK]
+            query = MOODLEUSER_SELECT.format(",".join("?"*len(chunk)))
+            for row in self.db.execute(query, chunk):
+                found[row["imisid"]] = row["moodleid"]
+        return found
+
+    def addMoodleIDs(self, idmap):
+        self.db.executemany(MOODLEUSER_ROW, idmap.items())
+        self.db.commit()
+
+    def forgetMoodleIDs(self, imisids):
+        # the moodle account may have been deleted or recreated. Look it up (or create it) again next
+        # time, and have the next full sync check all of the user's enrolments rather than trust the snapshot.
+        imisids = [(i,) for i in imisids]
+        self.db.executemany(MOODLEUSER_DELETE, imisids)
+        self.db.executemany(ENROLSNAPSHOT_FORGET, imisids)
+        self.db.commit()
+
+    def clearStage(self):
+        self.db.execute("DELETE FROM stagemember;")
+        self.db.execute("DELETE FROM stageuser;")
+        self.db.commit()
+
+    def stageUsers(self, users):
+        # [{"username", "email"}], returns the users seen for the first time in this full sync
+        new = {user["username"] for user in users
+            if self.db.execute(STAGEUSER_ROW, (user["username"], user["email"])).rowcount == 1}
+        self.db.commit()
+        return new
+
+    def getStagedUsers(self, imisids):
+        imisids = list(imisids)
+        users = []
+        for i in range(0, len(imisids), SELECT_CHUNK):
+            chunk = imisids[i:i+SELECT_CHUNK]
+            query = STAGEUSER_SELECT.format(",".join("?"*len(chunk)))
+            users.extend({"username": row["imisid"], "email": row["email"]} for row in self.db.execute(query, chunk))
+        return users
+
+    def stageMembers(self, members):
+        # [(courseid, imisid)]
+        self.db.executemany(STAGEMEMBER_ROW, members)
+        self.db.commit()
+
+    def diffStagedEnrolments(self, courseid):
+        # compare staged course members against what was last enrolled.
+        # Old snapshot rows count as not enrolled so drift in moodle gets fixed eventually.
+        stale = time.time()-(self.config.get("SNAPSHOT_MAX_AGE", 24*7)*60*60)
+        added = [row["imisid"] for row in self.db.execute(STAGEMEMBER_ADDED, (courseid, courseid, stale))]
+        removed = [row["imisid"] for row in self.db.execute(STAGEMEMBER_REMOVED, (courseid, courseid))]
+        return added, removed
+
+    def addEnrolments(self, enrolments):
+        # [(courseid, imisid)]
+        t = time.time()
+        self.db.executemany(ENROLSNAPSHOT_ROW, ((c, i, t) for c, i in enrolments))
+        self.db.commit()
+
+    def removeEnrolments(self, courseid, imisids):
+        self.db.executemany(ENROLSNAPSHOT_DELETE, ((courseid, i) for i in imisids))
+        self.db.commit()
+
+    def queueUsers(self, imisids):
+        t = time.time()
+        self.db.executemany(PENDINGUSER_ROW, ((i, t) for i in imisids))
+        self.db.commit()
+
+    def requeueUsers(self, imisids):
+        # back in pendinguser, even if the worker finished them moments ago. The receiver hands them
+        # out again after RECEIVER_INFLIGHT_TIME.
+        imisids = list(imisids)
+        self.finished.difference_update(imisids)
+        self.queueUsers(imisids)
+
+    def getQueuedUsers(self, before=None):
+        # before: only users queued before this time
+        if before is None: before = float("inf")
+        return [row["imisid"] for row in self.db.execute(PENDINGUSER_SELECT, (before,))]
+
+    def finishUser(self, imisid):
+        self.finished.add(imisid)
+        self.maybeFlushUsers()
+
+    def courseGroups(self):
+        groupcourses = {} # groupid: [list of courses]
+        for gid, cids in self.getPanelSource()["CMap"].items():
+            for ci in cids.split(","):
+                ci = ci.strip()
+                if ci == "": continue
+                groupcourses.setdefault(gid, []).append(ci)
+        return groupcourses
+
+    def queueFullSync(self):
+        # The full sync is split into small jobs that any worker can pick up between user updates:
+        # gather a few groups at a time, then enrol one course at a time, then finish.
+        # A user in several courses is still fetched, resolved and created once, not once per course.
+        groupcourses = self.courseGroups()
+        gids = sorted(groupcourses)
+        size = self.config.get("SYNC_GROUPS_PER_JOB", 10)
+        jobs = [(STAGE_GATHER, {gid: groupcourses[gid] for gid in gids[i:i+size]}) for i in range(0, len(gids), size)]
+        jobs.extend((STAGE_ENROL, cid) for cid in sorted({cid for cids in groupcourses.values() for cid in cids}))
+        jobs.append((STAGE_FINISH, None))
+        self.queueSyncJobs(jobs)
+        logger.debug("Cache - queued full sync, %s groups, %s jobs", len(gids), len(jobs))
+        return len(jobs)
+
+    def queueSyncJobs(self, jobs):
+        # [(stage, data)], replaces whatever was left of the previous full sync
+        self.db.execute("DELETE FROM syncjob;")
+        self.db.execute("DELETE FROM stagemember;")
+        self.db.execute("DELETE FROM stageuser;")
+        self.db.executemany(SYNCJOB_ROW, ((stage, json.dumps(data)) for stage, data in jobs))
+        self.db.commit()
+
+    def claimSyncJob(self, owner=None, worker=None):
+        # next runnable unit or None. Units claimed by a worker that died are handed out again after SYNC_JOB_TIMEOUT.
+        # owner is the sync task run (see heartbeat) the worker belongs to, worker its pid.
+        now = time.time()
+        self.db.execute("BEGIN IMMEDIATE;")
+        try:
+            job = self.db.execute(SYNCJOB_CLAIM, (now - self.config.get("SYNC_JOB_TIMEOUT", 30*60),)).fetchone()
+            if job is None: return None
+            self.db.execute(SYNCJOB_OWNED, (now, owner, worker, job["id"]))
+            return {"id": job["id"], "stage": job["stage"], "data": json.loads(job["data"])}
+        finally:
+            self.db.commit()
+
+    def finishSyncJob(self, jobid):
+        self.db.execute(SYNCJOB_DONE, (jobid,))
+        self.db.commit()
+
+    def deferSyncJob(self, jobid, until):
+        # hand the unit out again at until instead of after SYNC_JOB_TIMEOUT
+        self.db.execute(SYNCJOB_CLAIMED, (until - self.config.get("SYNC_JOB_TIMEOUT", 30*60), jobid))
+        self.db.commit()
+
+    def failSyncJob(self, jobid):
+        # A unit that raised is tried again after SYNC_JOB_RETRY seconds, SYNC_JOB_ATTEMPTS times in all. Then it
+        # is given up on (marked done), or the later stages and every following full sync would wait on it for ever.
+        # Returns True when given up.
+        retry = time.time() + self.config.get("SYNC_JOB_RETRY", 60)
+        self.db.execute(SYNCJOB_FAILED, (retry - self.config.get("SYNC_JOB_TIMEOUT", 30*60), jobid))
+        attempts = self.db.execute(SYNCJOB_ATTEMPTS, (jobid,)).fetchone()[0]
+        gaveup = attempts >= self.config.get("SYNC_JOB_ATTEMPTS", 5)
+        if gaveup: self.db.execute(SYNCJOB_DONE, (jobid,))
+        self.db.commit()
+        return gaveup
+
+    def heartbeat(self, owner):
+        # a sync task run is alive while it keeps calling this
+        self.db.execute(SYNCRUN_ROW, (owner, time.time()))
+        self.db.commit()
+
+    def releaseSyncJobs(self):
+        # On start, hand out again units claimed by runs that stopped heartbeating (crashed or killed).
+        # Cron runs overlap, units still held by the last run's workers stay claimed.
+        since = time.time() - self.config.get("SYNC_RUN_TIMEOUT", 180)
+        self.db.execute(SYNCJOB_RELEASE, (since,))
+        self.db.execute(SYNCRUN_EXPIRE, (since,))
+        self.db.commit()
+        return self.syncJobsPending()
+
+    def releaseOwnSyncJobs(self, owner, worker=None):
+        # units held by a run's workers that were stopped (maybe killed mid job), or by the one worker that died.
+        # They would otherwise stay claimed for SYNC_JOB_TIMEOUT while the run carries on heartbeating.
+        if worker is None: self.db.execute(SYNCJOB_RELEASE_OWNER, (owner,))
+        else: self.db.execute(SYNCJOB_RELEASE_WORKER, (owner, worker))
+        self.db.commit()
+
+    def endRun(self, owner):
+        # once the run's workers have stopped, whatever they didn't finish is free for the next run
+        self.db.execute(SYNCJOB_RELEASE_OWNER, (owner,))
+        self.db.execute(SYNCRUN_DELETE, (owner,))
+        self.db.commit()
+
+    def syncJobsPending(self):
+        return self.db.execute(SYNCJOB_PENDING).fetchone()[0]
+
+    def saveMetrics(self, holder, snapshot):
+        self.db.execute(METRICS_ROW, (holder, time.time(), json.dumps(snapshot)))
+        self.db.commit()
+
+    def loadMetrics(self):
+        # All of them for counters and histograms, or totals would dip until the sweep retires an old snapshot.
+        # Gauges only from processes heard from within METRICS_MAX_AGE. See metrics.merge.
+        since = time.time() - self.config.get("METRICS_MAX_AGE", 60*60)
+        snapshots = []
+        for row in self.db.execute(METRICS_SELECT):
+            snapshot = json.loads(row["json"])
+            if row["updated"] < since: snapshot["gauges"] = []
+            snapshot.update(holder=row["holder"], updated=row["updated"])
+            snapshots.append(snapshot)
+        return snapshots
+
+_metricsdbs = {} # dbpath: CacheDB
+_metricspid = None
+_metricslock = threading.Lock()
+
+def loadMetrics(config, dbpath):
+    # for the flask /metrics route. One connection per process and database, not one per scrape, and
+    # sqlite connections must not cross a fork. flask may serve requests from several threads.
+    global _metricspid
+    with _metricslock:
+        if _metricspid != os.getpid():
+            _metricsdbs.clear()
+            _metricspid = os.getpid()
+        if dbpath not in _metricsdbs: _metricsdbs[dbpath] = CacheDB(config, dbpath, shared=True)
+        return _metricsdbs[dbpath].loadMetrics()
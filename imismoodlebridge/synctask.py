@@ -1,27 +1,38 @@
 import socket
+import selectors
 import os
 import json
-from multiprocessing import Process, Queue, connection
+from multiprocessing import Process, Queue, BoundedSemaphore, Event
+from urllib.parse import urlparse
 import queue
+from concurrent.futures import ThreadPoolExecutor
 import time
 import datetime
-import re
+import contextlib
 import traceback
+import argparse
 from iMISpy import openAPI
-import requests
 import logging
 from logging.handlers import TimedRotatingFileHandler
 import signal
 
-from .synccache import CacheDB
-
-GET_MOODLE_ID = re.compile(r"""<KEY name="id">\s*<VALUE>([^<]+)<\/VALUE>\s*<\/KEY>\s*<KEY name="username">\s*<VALUE>([^<]+)<\/VALUE>""")
+from .synccache import CacheDB, STAGE_GATHER, STAGE_ENROL, STAGE_FINISH
+from . import httpclient
+from . import metrics
+from .moodle import MoodleClient, MoodleError, bisectBatches
+from .enrolment import EnrolmentScheduler, ENROLLED, BAD_USER, TRANSIENT
+from .fetch import iterGroupMembers, throttled
+from .ratelimit import RateLimiter, BackendUnavailable
 
 INSTANCE_PATH = os.getcwd()
 SOCKET_PATH = os.path.join(INSTANCE_PATH, "socket")
 CONFIG_PATH = os.path.join(INSTANCE_PATH, "config.json")
 CACHE_DB_PATH = os.path.join(INSTANCE_PATH, "cache.sqlite")
 LOG_PATH = os.path.join(INSTANCE_PATH, "synclog.txt")
+PROFILE_PATH = os.path.join(INSTANCE_PATH, "profiles")
+STAGE_NAMES = {STAGE_GATHER: "gather", STAGE_ENROL: "enrol", STAGE_FINISH: "finish"}
+# owner of the full sync units this run's workers claim, the workers inherit it
+RUN_ID = f"{socket.gethostname()}-{os.getpid()}-{time.time():.0f}"
 
 CONFIG = json.load(open(CONFIG_PATH, "rb"))
 
@@ -36,229 +47,562 @@ flogger.setFormatter(formatter)
 rootlogger.addHandler(flogger)
 logger = logging.getLogger(__name__)
 logger.setLevel(CONFIG.get("LOG_LEVEL", "WARN"))
+httpclient.configure(CONFIG)
+
+def moodleClient():
+    return MoodleClient(CONFIG['MOODLE_URL'], CONFIG["MOODLE_SYNC_TOKEN"])
 
 class UserReceiver(Process):
-    def __init__(self, q):
+    # Accepts newline delimited iMIS IDs from any number of connections (the flask notifier keeps one open).
+    # IDs already queued and not yet reported done by a worker are not queued again.
+    def __init__(self, q, done):
         super().__init__()
         self.q = q
-        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.done = done
+        self.inflight = {} # imisid: time queued
+        self.sock = None
+        self.metricssaved = 0
+        self.requeued = time.time()
+        self.stopping = Event()
+
+    def stop(self, timeout=10):
+        # Killing it could leave q or done locked halfway through a put/get while the workers carry on
+        # using them, so ask it to stop between reads. SIGTERM is only for one that doesn't.
+        self.stopping.set()
+        self.join(timeout)
+        if self.is_alive():
+            logger.warning("Receiver did not stop, terminating.")
+            self.terminate()
+            self.join()
 
     def run(self):
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        self.cache = CacheDB(CONFIG, CACHE_DB_PATH)
+        self.received = []
+        # anything received but not processed before the last shutdown
+        for imisid in self.cache.getQueuedUsers(): self.receive(imisid)
+        self.flushReceived()
         logger.debug("Starting receiver. unlinking socket...")
         try: os.unlink(SOCKET_PATH)
         except FileNotFoundError: pass
+        # created here so the parent process doesn't keep a copy of the listening socket
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         self.sock.bind(SOCKET_PATH)
-        self.sock.listen()
+        self.sock.listen(128)
+        self.sock.setblocking(False)
+        sel = selectors.DefaultSelector()
+        sel.register(self.sock, selectors.EVENT_READ, None)
         logger.debug("Receiver - listening.")
+        while not self.stopping.is_set():
+            for key, mask in sel.select(timeout=1):
+                if key.data is None: self.accept(sel)
+                else: self.read(sel, key)
+            self.flushReceived()
+            self.expireInflight()
+            if time.time() - self.requeued > 60: self.requeueStale()
+            if time.time() - self.metricssaved > CONFIG.get("METRICS_SAVE_INTERVAL", 10): self.saveMetrics()
+        # Left in place, a newer run's receiver may already have replaced it. Connecting to a closed one
+        # is refused, the same as no socket.
+        for key in list(sel.get_map().values()): key.fileobj.close()
+        sel.close()
+        logger.debug("Receiver - stopped.")
+
+    def accept(self, sel):
+        conn, client_address = self.sock.accept()
+        logger.debug(f"Receiver - Connection ({conn}) from ({client_address})")
+        conn.setblocking(False)
+        sel.register(conn, selectors.EVENT_READ, bytearray())
+
+    def read(self, sel, key):
+        conn, buf = key.fileobj, key.data
+        try: data = conn.recv(4096)
+        except ConnectionError: data = b""
+        if data:
+            buf.extend(data)
+            *lines, rest = buf.split(b"\n")
+            buf[:] = rest
+            for line in lines:
+                if line.strip() == b"stats": self.sendStats(conn)
+                else: self.receive(line)
+            if len(buf) > 1024: # not one of ours
+                logger.debug("Receiver - junk on connection, closing.")
+                data = b""
+                buf.clear()
+        if not data:
+            # old style clients send one ID without a newline and close
+            if buf: self.receive(bytes(buf))
+            sel.unregister(conn)
+            conn.close()
+
+    def receive(self, line):
+        try: imisid = str(int(line))
+        except ValueError: return
+        if imisid in self.inflight:
+            logger.debug("Receiver - %s already queued.", imisid)
+            return
+        self.inflight[imisid] = time.time()
+        self.received.append(imisid)
+
+    def flushReceived(self):
+        # on disk first so they survive a restart, workers remove them when done.
+        if not self.received: return
+        # a worker would only skip users updated within USER_CACHE_TIME, don't queue them at all
+        expired = set(self.cache.filterExpired(self.received))
+        for imisid in self.received:
+            if imisid not in expired:
+                logger.debug("Receiver - %s updated recently, skipping.", imisid)
+                self.inflight.pop(imisid, None)
+        self.received = [imisid for imisid in self.received if imisid in expired]
+        if not self.received: return
+        self.cache.queueUsers(self.received)
+        for imisid in self.received: self.q.put((None, imisid))
+        self.received = []
+
+    def saveMetrics(self):
+        metrics.gauge("sync_queue_depth", self.q.qsize())
+        metrics.gauge("sync_inflight_users", len(self.inflight))
+        metrics.gauge("sync_pending_users", len(self.cache.getQueuedUsers()))
+        metrics.gauge("sync_jobs_pending", self.cache.syncJobsPending())
+        self.cache.saveMetrics(f"receiver-{os.getpid()}", metrics.getRegistry().snapshot())
+        self.metricssaved = time.time()
+
+    def sendStats(self, conn):
+        # "stats\n" on the socket gets back every synctask process's metrics as prometheus text
+        self.saveMetrics()
+        text = metrics.render(metrics.merge(self.cache.loadMetrics()))
+        try:
+            conn.settimeout(5)
+            conn.sendall(text.encode())
+        except OSError as e: logger.debug("Receiver - could not send stats: %s", e)
+        finally: conn.setblocking(False)
+
+    def expireInflight(self):
         while True:
-            connection, client_address = self.sock.accept()
-            logger.debug(f"Receiver - Connection ({connection}) from ({client_address})")
-            data = connection.recv(1024).decode()
-            if data == "": 
-                logger.debug("Receiver - Received blank, quitting...")
-                break
-            try: q.put((None, str(int(data))))
-            except ValueError: pass
-            connection.close()
-        self.sock.close()
-
-def createMoodleUsers(users):
-    # this will be slow because we cannot batch create multiple users.
-    # if you try, and there's a problem with one user, the whole batch call fails. unfortunate.
-    postdata = {
-            "wstoken": CONFIG["MOODLE_SYNC_TOKEN"],
-            "wsfunction": "core_user_create_users"
-    }
-    for user in users:
-        logger.debug(f"CREATING user: %s", user["username"])
-        postdata[f"users[0][username]"] = user["username"]
-        postdata[f"users[0][auth]"] = "userkey"
-        postdata[f"users[0][firstname]"] = "New"
-        postdata[f"users[0][lastname]"] = "User"
-        postdata[f"users[0][email]"] = user["email"]
-        response = requests.post(f"{CONFIG['MOODLE_URL']}/webservice/rest/server.php",
-            data=postdata)
-        if "EXCEPTION" in response.text:
-            logger.debug("ERROR - Postdata: %s", postdata)
-    return
-
-
-def convertUserMoodleID(users):
-    postdata = {
-            "wstoken": CONFIG["MOODLE_SYNC_TOKEN"],
-            "wsfunction": "core_user_get_users_by_field",
-            "field" : "username"
-    }
+            try: self.inflight.pop(self.done.get_nowait(), None)
+            except queue.Empty: break
+        # in case a worker died before reporting back
+        old = time.time() - CONFIG.get("RECEIVER_INFLIGHT_TIME", 300)
+        for imisid in [i for i, t in self.inflight.items() if t < old]:
+            del self.inflight[imisid]
+
+    def requeueStale(self):
+        # users still on disk long after they were queued were lost by a worker that died or restarted
+        old = time.time() - CONFIG.get("RECEIVER_INFLIGHT_TIME", 300)
+        for imisid in self.cache.getQueuedUsers(before=old): self.receive(imisid)
+        self.requeued = time.time()
+
+def createMoodleUsers(users, cache=None):
+    # core_user_create_users fails the whole batch if there's a problem with one user,
+    # so bad users are bisected out and remembered so later runs skip them.
+    stats = {"calls": 0, "isolated": 0, "skipped": 0}
+    if cache is not None:
+        baduser = cache.getBadUsers()
+        stats["skipped"] = sum(1 for user in users if user["username"] in baduser)
+        users = [user for user in users if user["username"] not in baduser]
+    def send(batch):
+        logger.debug("CREATING users: %s", [user["username"] for user in batch])
+        try:
+            moodleClient().createUsers({"username": user["username"], "auth": "userkey",
+                "firstname": "New", "lastname": "User", "email": user["email"]} for user in batch)
+        except MoodleError as e:
+            logger.debug("ERROR - %s", e)
+            return False
+        return True
+    bad = bisectBatches(users, CONFIG.get("MOODLE_CREATE_BATCH", 50), send, stats)
+    metrics.inc("moodle_create_calls_total", stats["calls"])
+    metrics.inc("moodle_users_isolated_total", stats["isolated"])
+    metrics.inc("moodle_users_skipped_total", stats["skipped"])
+    if bad:
+        logger.warning("Could not create users: %s", [user["username"] for user in bad])
+        if cache is not None: cache.addBadUsers(user["username"] for user in bad)
+    logger.debug("Create users stats: %s", stats)
+    return stats
+
+
+def lookupMoodleIDs(users):
+    return {user.username: str(user.id) for user in moodleClient().getUsersByField("username", users)}
+
+def convertUserMoodleID(users, cache=None):
+    # known users come from the cache, the rest are looked up in bounded chunks
+    # (php max_input_vars) in parallel over the pooled session.
+    users = list(users)
     logger.debug(f"Converting users: %s", users)
-    for i, user in enumerate(users):
-        postdata[f"values[{i}]"] = user
-    logger.debug("Post data: %s", postdata)
-    response = requests.post(f"{CONFIG['MOODLE_URL']}/webservice/rest/server.php",
-        data=postdata).text
-    foundusers = {}
-    for mid, imisid in GET_MOODLE_ID.findall(response):
-        foundusers[imisid] = mid
+    foundusers = cache.getMoodleIDs(users) if cache is not None else {}
+    unknown = [user for user in users if user not in foundusers]
+    if unknown:
+        size = CONFIG.get("MOODLE_LOOKUP_CHUNK", 100)
+        chunks = [unknown[i:i+size] for i in range(0, len(unknown), size)]
+        newusers = {}
+        with ThreadPoolExecutor(CONFIG.get("MOODLE_LOOKUP_WORKERS", 4)) as pool:
+            for result in pool.map(lookupMoodleIDs, chunks):
+                newusers.update(result)
+        if cache is not None and newusers: cache.addMoodleIDs(newusers)
+        foundusers.update(newusers)
     logger.debug(f"Got users: %s", foundusers.values())
     return foundusers
 
-# enrollments is a list of (moodle user id, moodle course id)
-def processEnrollments(enrollments):
-    postdata = {
-        "wstoken": CONFIG["MOODLE_SYNC_TOKEN"],
-        "wsfunction": "enrol_manual_enrol_users",
-    }
-    for i, e in enumerate(enrollments):
-        postdata[f"enrolments[{i}][roleid]"] = CONFIG.get("STUDENT_ROLE_ID", 5)
-        postdata[f"enrolments[{i}][userid]"] = e[0]
-        postdata[f"enrolments[{i}][courseid]"] = e[1]
-    logger.debug("Sending enrollment data: %s", postdata)
-    requests.post(f"{CONFIG['MOODLE_URL']}/webservice/rest/server.php",
-        data=postdata)
-
-def userProcess(cache, api, imisid):
+def applyEnrolResults(cache, enrol):
+    # record finished enrolments in the snapshot. Failed users get re-processed on their next update.
+    # Only when moodle says the user is gone is their moodle ID looked up again, in case the account was
+    # deleted or recreated. A bad course says nothing about its members' accounts.
+    # Ones that never got an answer (moodle unreachable) are queued again as they are.
+    done = []
+    baduser = set()
+    retry = set()
+    for imisid, uid, cid, result in enrol.results():
+        if result == ENROLLED: done.append((cid, imisid))
+        else:
+            logger.warning("Enrolment failed (%s), iMIS ID: %s, Moodle user: %s, course: %s", result, imisid, uid, cid)
+            cache.expireUser(imisid)
+            if result == BAD_USER: baduser.add(imisid)
+            elif result == TRANSIENT: retry.add(imisid)
+    if done: cache.addEnrolments(done)
+    if baduser: cache.forgetMoodleIDs(baduser)
+    if retry: cache.requeueUsers(retry)
+
+def processUnenrollments(enrollments):
+    # enrollments: [(moodle user id, course id)]. Sent in ENROL_BATCH_SIZE batches (php max_input_vars),
+    # moodle fails a whole batch on one bad item so those are bisected out. Returns the rejected pairs.
+    enrolments = [{"userid": e[0], "courseid": e[1]} for e in enrollments]
+    if not enrolments: return []
+    logger.debug("Sending unenrollment data: %s", enrolments)
+    def send(batch):
+        try: moodleClient().unenrolUsers(batch)
+        except MoodleError as e:
+            logger.debug("ERROR - %s", e)
+            return False
+        return True
+    stats = {"calls": 0, "isolated": 0}
+    bad = bisectBatches(enrolments, CONFIG.get("ENROL_BATCH_SIZE", 100), send, stats)
+    metrics.inc("unenrolments_total", len(enrolments) - len(bad), result="ok")
+    metrics.inc("unenrolments_total", len(bad), result="rejected")
+    if bad: logger.warning("Could not unenrol: %s", bad)
+    return [(e["userid"], e["courseid"]) for e in bad]
+
+def userProcess(cache, api, enrol, imisid):
     if not cache.isUserExpired(imisid): 
         logger.debug(f"Skipping user: %s", imisid)
         return
     logger.debug("Processing user: %s", imisid)
     courses = []
     user = None
-    for item in api.apiIterator("GroupMember", [["PartyID", imisid]]):
-        if item["Group"]["GroupId"] in cache.getPanelSource()["CMap"]: # this checks for literal Group IDs->CourseID
-            cids = cache.getPanelSource()["CMap"][item["Group"]["GroupId"]]
+    cmap = cache.getPanelSource()["CMap"]
+    for item in throttled(api.apiIterator("GroupMember", [["PartyID", imisid]]), "imis", "GroupMember"):
+        if item["Group"]["GroupId"] in cmap: # this checks for literal Group IDs->CourseID
+            cids = cmap[item["Group"]["GroupId"]]
             for c in cids.split(","):
                 c = c.strip()
                 if c != "": courses.append(c)
             if not user:
                 user = {"username": imisid, "email": item["Party"]["Email"] }
     if courses:
-        uids = convertUserMoodleID([imisid])
+        uids = convertUserMoodleID([imisid], cache)
         logger.debug("Got user map: %s", uids)
         if imisid not in uids: 
-            createMoodleUsers([user])
-            uids = convertUserMoodleID([imisid])
+            createMoodleUsers([user], cache)
+            uids = convertUserMoodleID([imisid], cache)
         if imisid in uids:
             uid = uids[imisid]
             logger.debug("Found UID %s for iMIS ID %s", uid, imisid)
-            processEnrollments(((uid, cid) for cid in courses))
+            for cid in courses: enrol.submit(uid, cid, imisid)
             cache.updateUser(imisid)
     else:
         logger.debug("No courses to process.")
 
-def fullSync(cache, q):
-    synccourses = {} # coursid: [list of groups]
-    for gid, cids in cache.getPanelSource()["CMap"].items():
-        for ci in cids.split(","):
-            ci = ci.strip()
-            if ci == "": continue
-            if ci in synccourses: synccourses[ci].append(gid)
-            else: synccourses[ci] = [gid]
-    for cid in synccourses:
-        logger.debug("Queuing course sync: %s - %s", cid, synccourses[cid])
-        q.put(("course", (cid, synccourses[cid])))
-    q.put(("fulldone",None))
-    for x in range(CONFIG.get("WORKERS", 2)):
-        q.put(None)
-
-def courseSync(api, d):
-    # (courseID, [groups])
-    logger.debug("Processing course: %s", d)
+def resolveUsers(cache, users):
+    # make sure the users exist in moodle, resolved IDs end up in the moodleuser cache.
+    uids = convertUserMoodleID((user["username"] for user in users), cache)
+    missing = [user for user in users if user["username"] not in uids]
+    if missing:
+        createMoodleUsers(missing, cache)
+        convertUserMoodleID((user["username"] for user in missing), cache)
+
+def gatherMembers(cache, api, groupcourses):
+    # Stages 1+2: page every mapped group once (concurrently), stage memberships in cache.sqlite,
+    # and resolve each user the first time they're seen, in chunks, while the fetch carries on.
+    # Several workers can be gathering at once, so staging is written in short batches.
+    chunksize = CONFIG.get("MOODLE_LOOKUP_CHUNK", 100)
+    members = []
     users = {}
-    for gid in d[1]:
-        for imisdata in api.apiIterator("GroupMemberSummary", [["GroupID", gid]]):
-            gmimisid = imisdata["Party"]["Id"]
-            if gmimisid not in users:
-                users[gmimisid] = {
-                    "username": gmimisid,
-                    "email": imisdata["Party"]["Email"]
-                }
-    uids = convertUserMoodleID(users.keys())
-    missing = []
-    for iid in users:
-        if iid not in uids:
-            missing.append(users[iid])
+    newusers = []
+    def stage():
+        cache.stageMembers(members)
+        new = cache.stageUsers(users.values())
+        newusers.extend(user for username, user in users.items() if username in new)
+        members.clear()
+        users.clear()
+    for gid, user in iterGroupMembers(api, groupcourses.keys(), CONFIG):
+        members.extend((cid, user["username"]) for cid in groupcourses[gid])
+        users[user["username"]] = user
+        if len(members) >= 1000 or len(users) >= chunksize: stage()
+        if len(newusers) >= chunksize:
+            resolveUsers(cache, newusers)
+            newusers = []
+    stage()
+    if newusers: resolveUsers(cache, newusers)
+
+def enrolCourse(cache, enrol, cid):
+    # Stage 3: only touch moodle for what changed since the last sync of this course.
+    # Enrolments are recorded every SYNC_CHECKPOINT users, a restarted course carries on from there.
+    added, removed = cache.diffStagedEnrolments(cid)
+    # users updated through a login moments ago already have all their courses
+    expired = cache.filterExpired(added)
+    logger.debug("Course %s: %s to enrol (%s just updated), %s removed", cid, len(expired), len(added) - len(expired), len(removed))
+    added = expired
+    uids = cache.getMoodleIDs(added)
+    baduser = cache.getBadUsers()
+    missing = [imisid for imisid in added if imisid not in uids and imisid not in baduser]
     if missing:
-        createMoodleUsers(missing)
-        uids = convertUserMoodleID(users)
-    enrollments = []
-    for uid in uids.values():
-        enrollments.append((uid, d[0]))
-    processEnrollments(enrollments)
-
-def userProcessor(q):
+        # staged by a gather job that was cut short before resolving them
+        resolveUsers(cache, cache.getStagedUsers(missing))
+        uids.update(cache.getMoodleIDs(missing))
+    checkpoint = CONFIG.get("SYNC_CHECKPOINT", 1000)
+    for i, (imisid, uid) in enumerate(uids.items(), 1):
+        enrol.submit(uid, cid, imisid)
+        if i % checkpoint == 0:
+            enrol.wait()
+            applyEnrolResults(cache, enrol)
+    if removed and CONFIG.get("SYNC_UNENROL", False):
+        uids = convertUserMoodleID(removed, cache)
+        bad = {uid for uid, c in processUnenrollments((uid, cid) for uid in uids.values())}
+        # rejected ones keep their snapshot row, the next full sync tries them again
+        cache.removeEnrolments(cid, [imisid for imisid in removed if uids.get(imisid) not in bad])
+
+def runSyncJob(cache, api, enrol, job):
+    logger.debug("Running sync job %s (stage %s)", job["id"], job["stage"])
+    with metrics.timer("fullsync_job_seconds", stage=STAGE_NAMES.get(job["stage"])):
+        runSyncStage(cache, api, enrol, job)
+    cache.finishSyncJob(job["id"])
+
+def runSyncStage(cache, api, enrol, job):
+    if job["stage"] == STAGE_GATHER: gatherMembers(cache, api, job["data"])
+    elif job["stage"] == STAGE_ENROL:
+        enrolCourse(cache, enrol, job["data"])
+        # the unit is only done once its enrolments are recorded
+        enrol.wait()
+        applyEnrolResults(cache, enrol)
+    elif job["stage"] == STAGE_FINISH:
+        cache.updateFullSync()
+        logger.debug("Full sync done")
+
+def runTask(cache, api, enrol, task, taskdata):
+    name = "user" if task is None else f"fullsync-{STAGE_NAMES.get(taskdata['stage'])}"
+    # PROFILE_TASKS saves a cProfile of each task (slower than PROFILE_MIN_TIME) in the instance profiles folder
+    profile = contextlib.nullcontext()
+    if CONFIG.get("PROFILE_TASKS", False): profile = metrics.profiled(name, PROFILE_PATH, CONFIG.get("PROFILE_MIN_TIME", 0))
+    with metrics.timer("task_seconds", task=name), profile:
+        if task is None: userProcess(cache, api, enrol, taskdata)
+        elif task == "job": runSyncJob(cache, api, enrol, taskdata)
+
+def nextTask(q, cache, bulk, state):
+    # Queued user updates (logins) always go first. Full sync units are only claimed when
+    # there's no user waiting, so a login waits at most for the unit in hand.
+    try: return q.get_nowait()
+    except queue.Empty: pass
+    if bulk and time.time() >= state["nextclaim"]:
+        job = cache.claimSyncJob(RUN_ID, os.getpid())
+        if job is not None: return ("job", job)
+        state["nextclaim"] = time.time() + 5
+    return q.get(timeout=1)
+
+def unpark(q, parked):
+    # user tasks put aside while a backend's circuit was open go back on the queue once it may have closed
+    now = time.time()
+    for item in [item for item in parked if item[0] <= now]:
+        parked.remove(item)
+        q.put(item[1])
+
+def userProcessor(q, done=None, limits=None, bulk=True):
     logger.debug("Starting user processor worker...")
+    if limits: httpclient.setLimits(limits)
     api = openAPI(CONFIG)
     cache = CacheDB(CONFIG, CACHE_DB_PATH)
-    data = q.get()
-    while data is not None:
+    httpclient.setLimiter(RateLimiter(CONFIG, CACHE_DB_PATH))
+    enrol = EnrolmentScheduler(moodleClient(), CONFIG)
+    state = {"nextclaim": 0, "metricssaved": 0}
+    parked = [] # (until, task)
+    while True:
+        if time.time() - state["metricssaved"] > CONFIG.get("METRICS_SAVE_INTERVAL", 10):
+            cache.saveMetrics(f"worker-{os.getpid()}", metrics.getRegistry().snapshot())
+            state["metricssaved"] = time.time()
+        unpark(q, parked)
+        try: data = nextTask(q, cache, bulk, state)
+        except queue.Empty:
+            applyEnrolResults(cache, enrol)
+            cache.flushUsers()
+            continue
+        if data is None: break
         # process user id and or <other thing>
         task, taskdata = data
         logger.debug("Got task (%s), with data (%s)", task, taskdata)
-        try:
-            if task is None: userProcess(cache, api, taskdata)
-            elif task == "full": fullSync(cache, q)
-            elif task == "fulldone": cache.updateFullSync()
-            elif task == "course": courseSync(api, taskdata)
+        try: runTask(cache, api, enrol, task, taskdata)
+        except BackendUnavailable as e:
+            # not the task's fault, run it again once the circuit has had time to close
+            metrics.inc("tasks_parked_total", backend=e.backend)
+            logger.warning("%s, retrying task (%s, %s) later.", e, task, taskdata if task is None else taskdata["id"])
+            if task is None:
+                # not reported done, so the receiver won't queue it again meanwhile
+                parked.append((e.until, data))
+                applyEnrolResults(cache, enrol)
+                continue
+            elif task == "job": cache.deferSyncJob(taskdata["id"], e.until)
         except Exception as e:
             if issubclass(e.__class__, KeyboardInterrupt): raise
             else: logger.critical(e, exc_info=True)
-        data = q.get()
+            # a failed unit is tried again after SYNC_JOB_RETRY seconds rather than SYNC_JOB_TIMEOUT, a few times
+            if task == "job" and cache.failSyncJob(taskdata["id"]):
+                metrics.inc("fullsync_jobs_abandoned_total", stage=STAGE_NAMES.get(taskdata["stage"]))
+                logger.error("Giving up on sync job %s (stage %s, %s) after %s attempts.", taskdata["id"],
+                    STAGE_NAMES.get(taskdata["stage"]), taskdata["data"], CONFIG.get("SYNC_JOB_ATTEMPTS", 5))
+        if task is None:
+            cache.finishUser(taskdata)
+            # let the receiver queue this user again
+            if done is not None: done.put(taskdata)
+        applyEnrolResults(cache, enrol)
+    enrol.close()
+    applyEnrolResults(cache, enrol)
+    cache.flushUsers()
+    cache.saveMetrics(f"worker-{os.getpid()}", metrics.getRegistry().snapshot())
+    # short of stopProcesses' timeout, the parent kills a worker that takes longer
+    cache.close(CONFIG.get("PANEL_REFRESH_WAIT", 30))
+    logger.debug("Enrolment stats: %s", enrol.stats)
     logger.debug("Finished processing worker.")
 
-if __name__ == '__main__':
-    runtime = time.time() + (CONFIG.get("WORKER_DUATION", 2) * 60) + 10
-    logger.debug(f"Running for {runtime-time.time():.1f} seconds.")
+def startProcess(p):
+    # children leave signals to the parent, which drains them with sentinels
+    handlers = {sig: signal.signal(sig, signal.SIG_IGN) for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP)}
+    try:
+        p.start()
+    finally:
+        for sig, handler in handlers.items(): signal.signal(sig, handler)
+    return p
+
+def stopProcesses(processes, q, timeout=60):
+    # sentinels go behind anything already queued, so workers finish what they have first.
+    # Only live workers get one, a spare would stop the next worker started on this queue.
+    for p in processes:
+        if p.is_alive(): q.put(None)
+    deadline = time.time() + timeout
+    for p in processes:
+        p.join(max(0, deadline - time.time()))
+        if p.is_alive():
+            logger.warning("Worker %s did not stop, killing.", p.pid)
+            p.kill()
+            p.join()
+
+def reloadConfig():
+    CONFIG.clear()
+    CONFIG.update(json.load(open(CONFIG_PATH, "rb")))
+    logger.setLevel(CONFIG.get("LOG_LEVEL", "WARN"))
+    httpclient.configure(CONFIG)
+
+def backendLimits():
+    # Shared by every worker, so requests in flight per backend don't grow with WORKERS.
+    # iMISpy does its own HTTP, its iterators are throttled by name (fetch.throttled) rather than host.
+    return {
+        "imis": (None, BoundedSemaphore(CONFIG.get("IMIS_CONCURRENCY", 8))),
+        "moodle": (urlparse(CONFIG["MOODLE_URL"]).hostname, BoundedSemaphore(CONFIG.get("MOODLE_CONCURRENCY", 8))),
+    }
+
+def bulkWorker(x):
+    # the first SYNC_BULK_WORKERS workers also take full sync units, the rest only do user updates
+    workers = CONFIG.get("WORKERS", 2)
+    return x < CONFIG.get("SYNC_BULK_WORKERS", max(1, workers - 1))
+
+def startWorker(q, done, limits, x):
+    return startProcess(Process(target=userProcessor, args=(q, done, limits, bulkWorker(x))))
+
+def startWorkers(q, done, limits=None):
+    limits = limits or backendLimits()
+    return [startWorker(q, done, limits, x) for x in range(CONFIG.get("WORKERS", 2))]
+
+def restartDeadWorkers(processes, q, done, limits, db):
+    # returns the workers and the limits they share. Full sync units the dead (or stopped) workers held
+    # are handed out again straight away.
+    dead = [x for x, p in enumerate(processes) if not p.is_alive()]
+    if not dead: return processes, limits
+    for x in dead: processes[x].join()
+    logger.error("Worker exited (%s), restarting it.", [processes[x].exitcode for x in dead])
+    if any(processes[x].exitcode < 0 for x in dead):
+        # Killed by a signal, maybe while holding a backend limit. Exceptions release them on the way
+        # out, so only then do the workers need fresh ones.
+        logger.warning("Worker killed, restarting workers with fresh backend limits.")
+        stopProcesses(processes, q)
+        db.releaseOwnSyncJobs(RUN_ID)
+        limits = backendLimits()
+        return startWorkers(q, done, limits), limits
+    for x in dead:
+        db.releaseOwnSyncJobs(RUN_ID, processes[x].pid)
+        processes[x] = startWorker(q, done, limits, x)
+    return processes, limits
+
+def main(daemon=False):
+    state = {"stop": False, "reload": False}
+    def onStop(signum, frame): state["stop"] = True
+    def onReload(signum, frame): state["reload"] = True
+    signal.signal(signal.SIGTERM, onStop)
+    signal.signal(signal.SIGHUP, onReload)
+    runtime = None if daemon else time.time() + (CONFIG.get("WORKER_DUATION", 2) * 60) + 10
+    if runtime: logger.debug(f"Running for {runtime-time.time():.1f} seconds.")
+    else: logger.debug("Running as daemon.")
     q = Queue()
-    fs = Queue() # full sync queue
+    done = Queue() # user IDs workers have finished with
     # check panelsource cache, fetch and update if old.
     db = CacheDB(CONFIG, CACHE_DB_PATH)
     db.getPanelSource() # pre-warm-cache data
+    # anything claimed by a run that died didn't finish, hand it out again
+    db.heartbeat(RUN_ID)
+    beat = time.time()
+    pending = db.releaseSyncJobs()
+    if pending: logger.warning("Resuming full sync, %s jobs left.", pending)
+    db.sweepExpired()
+    swept = time.time()
     # start receiver process
-    orig_sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN) # ignore sigINT for now...
-    r = UserReceiver(q)
-    r.start()
+    r = startProcess(UserReceiver(q, done))
     logger.debug("Starting workers")
-    processes = []
-    fullsyncprocesses = []
-    for x in range(CONFIG.get("WORKERS", 2)):
-        p = Process(target=userProcessor, args=(q, ))
-        processes.append(p)
-        p.start()
-    signal.signal(signal.SIGINT, orig_sigint_handler)
+    limits = backendLimits()
+    processes = startWorkers(q, done, limits)
     try:
-        while time.time() < runtime :
+        while not state["stop"] and (runtime is None or time.time() < runtime):
             time.sleep(0.5)
+            if state["reload"]:
+                logger.warning("SIGHUP, reloading config and restarting workers...")
+                state["reload"] = False
+                reloadConfig()
+                stopProcesses(processes, q)
+                db.releaseOwnSyncJobs(RUN_ID)
+                r.stop()
+                r = startProcess(UserReceiver(q, done))
+                limits = backendLimits()
+                processes = startWorkers(q, done, limits)
+            processes, limits = restartDeadWorkers(processes, q, done, limits, db)
+            if time.time() - beat > 10:
+                db.heartbeat(RUN_ID)
+                beat = time.time()
+            if time.time() - swept > CONFIG.get("SWEEP_INTERVAL", 600):
+                db.sweepExpired()
+                swept = time.time()
             # if hour of longprocess has passed:
             currenttime = datetime.datetime.now().time()
-            if not fullsyncprocesses and currenttime.hour == CONFIG.get("FULLSYNC_HOUR", 4) and currenttime.second > 20 and db.isFullSyncExpired():
+            if currenttime.hour == CONFIG.get("FULLSYNC_HOUR", 4) and currenttime.second > 20 and db.isFullSyncExpired() and not db.syncJobsPending():
                 logger.debug("Starting full sync.")
-                orig_sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN) # ignore sigINT for now...
-                for x in range(CONFIG.get("WORKERS", 2)):
-                    fp = Process(target=userProcessor, args=(fs, ))
-                    fullsyncprocesses.append(fp)
-                    fp.start()
-                signal.signal(signal.SIGINT, orig_sigint_handler)
-                fs.put(("full", None))
-        if fullsyncprocesses:
-            # wait for full sync if running...
-            logger.debug("Waiting for fullsync...")
-            connection.wait(fp.sentinel for fp in fullsyncprocesses)
-            logger.debug("Full sync done")
-            fullsyncprocesses = []
-
+                db.queueFullSync()
     except KeyboardInterrupt:
         logger.warning("CTRL+C, quitting...")
     except Exception as e: # better quit so no zombie... hope no exceptions later on...
         print("EXCEPTION RAISED")
         traceback.print_exc()
-    r.terminate()
-    for x in range(CONFIG.get("WORKERS", 2)):
-        logger.debug("Putting quit...")
-        q.put(None)
-    if fullsyncprocesses:
-        for x in fullsyncprocesses:
-            fs.put(None)
-        connection.wait(fp.sentinel for fp in fullsyncprocesses)
+    r.stop()
     logger.debug("Waiting for processes to exit...")
-    # for some reason the following doesn't actually wait and zombie process will keep main process alive.
-    # connection.wait(p.sentinel for p in processes)
+    # unfinished full sync units stay in cache.sqlite for the next run
+    stopProcesses(processes, q)
+    db.endRun(RUN_ID)
+    # a full panel pass can outlast a run, let it finish rather than start over next run
+    db.close(CONFIG.get("PANEL_LEASE_TIME", 600))
     logger.debug("Quitting.")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="iMIS -> Moodle sync task. Run from the instance folder.")
+    parser.add_argument("--daemon", action="store_true", default=CONFIG.get("SYNC_DAEMON", False),
+        help="keep running instead of exiting after WORKER_DUATION minutes. SIGHUP reloads config.json")
+    main(parser.parse_args().daemon)
@@ -0,0 +1,81 @@
+import json
+import random
+import pytest
+from imismoodlebridge.moodle import MoodleError, iterJSONArray, flattenParams, bisectBatches
+
+ITEMS = [
+    {"id": 2, "username": "1234", "email": "a@example.com", "customfields": [{"value": "x,y]"}]},
+    -350000000000000.0, 1.5e-3, -2E+10, 0, 17, 3.25,
+    True, False, None, "", "quoted \"]\" and \\ and , inside", "café ☃",
+    [], {}, [[1, 2], {"a": [3, {"b": None}]}],
+]
+
+def decode(chunks):
+    return list(iterJSONArray("test_function", chunks))
+
+def randomChunks(text, rng):
+    chunks = []
+    pos = 0
+    while pos < len(text):
+        size = rng.randint(1, 8)
+        chunks.append(text[pos:pos+size])
+        pos += size
+    return chunks
+
+def test_whole_array():
+    assert decode([json.dumps(ITEMS)]) == ITEMS
+
+def test_random_chunk_boundaries():
+    rng = random.Random(1)
+    for separators in ((",", ":"), (", ", ": "), (" ,\n ", " : ")):
+        text = " " + json.dumps(ITEMS, separators=separators) + "\n"
+        for _ in range(300):
+            assert decode(randomChunks(text, rng)) == ITEMS
+
+def test_number_cut_after_point():
+    # a number split right after "." must not come out as -3500000000000 and leave ".0" behind
+    assert decode(["[1, ", " -35000", "0000", "00.", "0, {}", "]"]) == [1, -35000000000.0, {}]
+
+@pytest.mark.parametrize("chunks, expected", [
+    (["[1", "e3]"], [1e3]),
+    (["[1e", "-3]"], [1e-3]),
+    (["[2E", "+", "4, 5]"], [2E+4, 5]),
+    (["[-", "7]"], [-7]),
+    (["[12", "", "3]"], [123]),
+    (["[tr", "ue, nu", "ll]"], [True, None]),
+])
+def test_number_and_literal_split(chunks, expected):
+    assert decode(chunks) == expected
+
+def test_empty_array():
+    assert decode(["  [", " ", "]  "]) == []
+
+def test_not_an_array():
+    assert decode(['{"id": 1', "}"]) == [{"id": 1}]
+    assert decode(["null"]) == []
+    assert decode([""]) == []
+
+def test_error_object():
+    with pytest.raises(MoodleError) as error:
+        decode(['{"exception": "moodle_exception", "errorcode": "invalid', 'token", "message": "Invalid token"}'])
+    assert error.value.errorcode == "invalidtoken"
+
+def test_truncated():
+    with pytest.raises(ValueError):
+        decode(['[{"id": 1}, {"id": 2'])
+    with pytest.raises(ValueError):
+        decode(['[{"id": 1},'])
+
+def test_flatten_params():
+    assert flattenParams({"users": [{"username": "x", "auth": "userkey"}], "field": "id"}) == [
+        ("users[0][username]", "x"), ("users[0][auth]", "userkey"), ("field", "id")]
+
+def test_bisect_isolates_bad_items():
+    calls = []
+    def send(batch):
+        calls.append(list(batch))
+        return not any(item in (3, 8) for item in batch)
+    stats = {"calls": 0, "isolated": 0}
+    assert bisectBatches(list(range(10)), 4, send, stats) == [3, 8]
+    assert stats == {"calls": len(calls), "isolated": 2}
+    assert sorted(item for batch in calls if 3 not in batch and 8 not in batch for item in batch) == [0, 1, 2, 4, 5, 6, 7, 9]